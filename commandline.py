@@ -18,6 +18,10 @@ def parse(list_of_extras=None, epilog=None):
         default=None,
         help="Specify ssh-key for remote login")
 
+    parser.add_argument(
+        "--sshconnections", dest="ssh_connections", default=0, type=int,
+        help="number of persistent ssh connections to the archive shared by all transfers (0: one new connection per transfer)")
+
     parser.add_argument(
         '--db', default=False, action='store_true',
         help="query ODI database")
@@ -26,13 +30,177 @@ def parse(list_of_extras=None, epilog=None):
         '--nthreads', default=5, type=int,
         help="number of threads for parallel transfer")
 
+    parser.add_argument(
+        '--adaptive', default=False, action='store_true',
+        help="adjust the number of active transfer threads to the measured throughput and CPU/IO load (starting at --nthreads)")
+
+    parser.add_argument(
+        '--minthreads', dest='min_threads', default=1, type=int,
+        help="minimum number of active transfer threads in adaptive mode")
+
+    parser.add_argument(
+        '--maxthreads', dest='max_threads', default=None, type=int,
+        help="maximum number of active transfer threads in adaptive mode (default: twice --nthreads)")
+
+    parser.add_argument(
+        '--adaptinterval', dest='adapt_interval', default=60, type=float,
+        help="seconds between two decisions of the adaptive mode")
+
+    parser.add_argument(
+        '--fpackthreads', dest='fpack_threads', default=4, type=int,
+        help="number of files within one exposure to compress in parallel")
+
+    parser.add_argument(
+        '--compressor', default='fpack', choices=['fpack', 'astropy'],
+        help="fpack: run the external fpack binary; astropy: in-process Rice tile compression")
+
+    parser.add_argument(
+        '--extradigest', dest='extra_digest', default=None, choices=['blake2b', 'blake2s', 'sha256'],
+        help="also compute this checksum for all files, stored next to md5.txt in the tar-ball")
+
+    parser.add_argument(
+        '--packaging', default='files', choices=['files', 'stream'],
+        help="files: fpack into the tar-prep directory, then run tar; stream: write fpack output straight into the tar-ball")
+
+    parser.add_argument(
+        '--protocol', default='rsync', choices=['rsync', 'scp', 'sftp', 'local', 'stream'],
+        help="how to transfer tar-balls to the archive; sftp needs paramiko, local copies to the remote directory on this machine (for testing)")
+
+    parser.add_argument(
+        '--stream', dest='protocol', action='store_const', const='stream',
+        help="stream tar-balls to the archive via ssh without writing the tar-ball to disk; compressed files larger than --spoolsize still go through the scratch directory (same as --protocol=stream)")
+
+    parser.add_argument(
+        '--spoolsize', dest='spool_size', default=256, type=float,
+        help="in streaming packaging, keep compressed files of up to this many MB in memory, larger ones go to the scratch directory; each exposure buffers up to 2x --fpackthreads files")
+
+    parser.add_argument(
+        '--nstreams', default=1, type=int,
+        help="send large tar-balls in this many parallel ssh streams, verified by checksum after joining them on the archive server")
+
+    parser.add_argument(
+        '--bundle', default=False, action='store_true',
+        help="send tar-balls of small exposures finishing at about the same time with a single rsync/scp call")
+
+    parser.add_argument(
+        '--bundlesize', dest='bundle_size', default=200, type=float,
+        help="in bundle mode, only tar-balls smaller than this many MB are bundled, up to this many MB per bundle")
+
+    parser.add_argument(
+        '--bundlecount', dest='bundle_count', default=10, type=int,
+        help="maximum number of exposures per bundle")
+
+    parser.add_argument(
+        '--bundlewait', dest='bundle_wait', default=5, type=float,
+        help="seconds to wait for more exposures to join a bundle")
+
+    parser.add_argument(
+        '--transfertimeout', dest='transfer_timeout', default=None, type=float,
+        help="kill transfers to the archive that take longer than this many seconds")
+
+    parser.add_argument(
+        '--transferretries', dest='transfer_retries', default=0, type=int,
+        help="try failed transfers to the archive again this many times before giving up")
+
+    parser.add_argument(
+        '--noverify', dest='verify', default=True, action='store_false',
+        help="do not compare the checksum of tar-balls on the archive server with ours after the transfer")
+
+    parser.add_argument(
+        '--verifywait', dest='verify_wait', default=2., type=float,
+        help="seconds to wait for more transfers to finish, to verify their tar-balls together")
+
+    parser.add_argument(
+        '--verifytimeout', dest='verify_timeout', default=600., type=float,
+        help="seconds after which checking the tar-balls on the archive server is given up, failing their exposures")
+
+    parser.add_argument(
+        '--fzcache', default=None,
+        help="directory to cache compressed files in, so re-sends do not need to compress them again")
+
+    parser.add_argument(
+        '--fzcachesize', dest='fzcache_size', default=100, type=float,
+        help="maximum size of the fz cache in GB; least recently used files are removed first")
+
+    parser.add_argument(
+        '--watch', dest='watch_dirs', default=None, action='append',
+        help="acquisition directory to watch for new FITS files, which get compressed into the fz cache right away (may be given more than once, needs --fzcache)")
+
+    parser.add_argument(
+        '--nocompletecheck', dest='check_complete', default=True, action='store_false',
+        help="do not check that all FITS files are completely written before sending an exposure")
+
+    parser.add_argument(
+        '--settletime', dest='settle_time', default=2., type=float,
+        help="files must not have changed for this many seconds before they are sent")
+
+    parser.add_argument(
+        '--incompletetimeout', dest='incomplete_timeout', default=30., type=float,
+        help="send exposures with incomplete files anyway once these did not change for this many minutes")
+
+    parser.add_argument(
+        '--deferwait', dest='defer_wait', default=30., type=float,
+        help="seconds to wait before trying an incomplete exposure again (when monitoring, it is retried at the next database check)")
+
+    parser.add_argument(
+        '--deltaresend', dest='delta_resend', default=False, action='store_true',
+        help="remember the checksums of all files sent, and only re-send files that changed (as <dir>.delta<N>.tar with a delta.txt listing the files to take from the last complete tar-ball)")
+
+    parser.add_argument(
+        '--shipmentlog', dest='shipment_log', default=None,
+        help="directory to keep the checksums of all files sent in (default: .odi_dts_shipped in the scratch directory)")
+
+    parser.add_argument(
+        '--scratchbudget', dest='scratch_budget', default=None, type=float,
+        help="maximum space in GB exposures may use in the scratch directory; exposures wait until enough space is free")
+
+    parser.add_argument(
+        '--headerindex', dest='header_index', default=None,
+        help="file to remember OBSIDs read from FITS headers in (default: .odi_dts_headers.json in the scratch directory)")
+
+    parser.add_argument(
+        '--pipeline', default=False, action='store_true',
+        help="overlap compression, tar, transfer and reporting of different exposures in a pipeline")
+
+    parser.add_argument(
+        '--stageworkers', dest='stage_workers', default="",
+        help="number of workers per pipeline stage, e.g. compress=2,transfer=5 (stages: scan, compress, tar, transfer, report)")
+
+    parser.add_argument(
+        '--queuedepth', dest='queue_depth', default=2, type=int,
+        help="number of exposures waiting between two pipeline stages")
+
+    parser.add_argument(
+        '--sjf', default=False, action='store_true',
+        help="transfer the smallest exposures first, with older exposures moving up (only in monitoring mode)")
+
+    parser.add_argument(
+        '--agingrate', dest='aging_rate', default=1., type=float,
+        help="in --sjf mode, each second of age moves an exposure ahead by this many MB")
+
+    parser.add_argument(
+        '--qos', default=False, action='store_true',
+        help="share transfer threads between fresh science data, calibrations, resends and backfill by weight (only in monitoring mode)")
+
+    parser.add_argument(
+        '--qosweights', dest='qos_weights', default="",
+        help="relative share of transfer threads per class, e.g. science=8,calibration=4,resend=2,backfill=1")
+
+    parser.add_argument(
+        '--qosbwlimit', dest='qos_bwlimit', default="",
+        help="bandwidth limit in KB/s per class for rsync/scp, e.g. resend=5000,backfill=2000")
+
+    parser.add_argument(
+        '--backfillage', dest='backfill_age', default=24, type=float,
+        help="exposures older than this many hours are treated as backfill in QoS mode")
+
     parser.add_argument(
         "--monitor", default=False, action="store_true",
         help="keep monitoring the database")
 
     parser.add_argument(
         "--chunksize", default=25, type=int,
-        help="number of frames to transfer between DB queries (only in monitoring mode)")
+        help="maximum number of frames queued or in transfer at any time (only in monitoring mode)")
 
     parser.add_argument(
         "--keep", dest="delete_when_done", default=True, action='store_false',
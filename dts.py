@@ -1,18 +1,37 @@
 
 import os
-import subprocess
-import glob
-import hashlib
-import pyfits
 import time
 import shutil
 import logging
-import psutil
+import concurrent.futures
+import tarfile
+import tempfile
+import io
+import threading
+import shlex
+import traceback
+
+import dts_checksum
+import dts_compress
+import dts_staging
+import dts_manifest
+import dts_delta
+import dts_transport
+import fits_header
+import dts_supervisor
 
 import config
 
 class DTS ( object ):
 
+    # in streaming mode, compressed files are buffered in memory up to this
+    # size before being appended to the tar-ball; larger ones spill to the
+    # scratch directory. Up to 2*fpack_threads files are buffered at a time,
+    # for each exposure being worked on
+    STREAM_SPOOL_SIZE = 256*2**20
+
+    # tar-balls smaller than this are not worth splitting across several streams
+    MULTISTREAM_MIN_SIZE = 64*2**20
 
     def __init__(self,
                  exposure_directory,
@@ -25,9 +44,32 @@ class DTS ( object ):
                  cleanup=True,
                  ppa=None,
                  extra=None,
+                 fpack_threads=1,
+                 packaging='files',
+                 sshkey=None,
+                 compressor='fpack',
+                 transfer_timeout=None,
+                 fz_cache=None,
+                 scratch_manager=None,
+                 bundler=None,
+                 ssh_pool=None,
+                 transfer_streams=1,
+                 bandwidth_limit=None,
+                 extra_digest=None,
+                 header_index=None,
+                 precompressor=None,
+                 check_complete=True,
+                 settle_time=2.,
+                 incomplete_timeout=1800.,
+                 shipment_log=None,
+                 transfer_retries=0,
+                 verifier=None,
+                 stream_spool_size=None,
                  ):
 
         self.logger = logging.getLogger(obsid if obsid is not None else "??????")
+        self.header_index = header_index
+        self.precompressor = precompressor
         self.database = database
         self.ppa = ppa
         self.extra = extra
@@ -64,28 +106,87 @@ class DTS ( object ):
 
         self.logger.info("Reading files from %s" % (self.dir_name))
 
-        self.tar_directory = os.path.join(self.scratch_dir, self.dir_name)
-        if (not os.path.isdir(self.tar_directory)):
-            self.logger.info("Creating tar-directory: %s" % (self.tar_directory))
-            os.mkdir(self.tar_directory)
+        if (transfer_protocol == 'stream' and packaging != 'stream'):
+            # streaming the transfer requires the tar-ball to be streamed as well
+            packaging = 'stream'
+        if (packaging not in ['files', 'stream']):
+            raise ValueError("Unknown packaging mode: %s" % (packaging))
+        self.packaging = packaging
 
+        self.tar_directory = os.path.join(self.scratch_dir, self.dir_name)
         self.tar_filename = os.path.join(self.scratch_dir, self.dir_name)+".tar"
 
         self.transfer_protocol = transfer_protocol
+        self.transport = dts_transport.get_transport(transfer_protocol, logger=self.logger) \
+            if transfer_protocol != 'stream' else None
+        self.transfer_retries = max(0, transfer_retries)
+        # how the tar-ball actually went out, for the database event
+        self.transfer_result = None
+        # checks the tar-ball on the archive server after the transfer
+        self.verifier = verifier
+        self.verification = None
+        self.remote_checksum = None
+        # done once the exposure is reported, if that happens in the background
+        self.reported = None
+        self.transfer_streams = max(1, transfer_streams)
+        # in KB/s, only for rsync and scp
+        self.bandwidth_limit = bandwidth_limit
+        self.fpack_threads = max(1, fpack_threads)
+        self.stream_spool_size = stream_spool_size if stream_spool_size is not None else self.STREAM_SPOOL_SIZE
+        self.compressor = dts_compress.get_compressor(compressor, execute=self.execute, logger=self.logger)
+        self.sshkey = sshkey
+        self.transfer_timeout = transfer_timeout
+        self.fz_cache = fz_cache
+        self.bundler = bundler
+        self.ssh_pool = ssh_pool
+        self.fz_cache_hits = 0
+        # only send exposures once all files are completely written, unless
+        # they have not changed for incomplete_timeout seconds
+        self.check_complete = check_complete
+        self.settle_time = settle_time
+        self.incomplete_timeout = incomplete_timeout
 
         if (remote_target is None):
             self.remote_target_directory = "%s:%s" % (config.remote_server, config.remote_directory)
         else:
             self.remote_target_directory = remote_target
+        if (self.transfer_protocol == 'stream' and ':' not in self.remote_target_directory):
+            raise ValueError("Streaming transfers need a remote target (server:directory)")
+        self.stream_process = None
+        self.stream_start_time = None
+
+        # progress through the different stages
+        self.tar_file_count = None
+        self.md5_data = []
+        self.transfer_successful = False
+        self.report_successful = False
+        self.error = None
+        # reason why this exposure has to be tried again later, if so
+        self.deferred = None
 
         self.tar_checksum = None
         self.tar_filesize = -1
+        # number of bytes checksummed while writing them, i.e. bytes we no
+        # longer need to read back from the scratch disk
+        self.bytes_checksummed = 0
+        self.bytes_checksummed_lock = threading.Lock()
+        # optional second checksum (e.g. blake2b) of each file, by file name
+        self.extra_digest = extra_digest
+        self.extra_digests = {}
+        self.tar_extra_digest = None
+        # md5 of every member of the tar-ball, including those not in md5.txt
+        self.member_md5 = {}
         self.tar_transfer_time = -1
         self.archive_ingestion_message = None
+        # wall-clock time spent in each stage, and the amount of raw data
+        self.stage_times = {}
+        self.bytes_in = self.manifest.total_bytes
 
         self.cleanup_when_complete = cleanup
         self.cleanup_filelist = []
         self.cleanup_directories = []
+        # files written to the tar-prep directory
+        self.prepared_files = []
 
         self.ppa_send = "send"
         self.ppa_send_complete = "send_complete"
@@ -93,160 +194,636 @@ class DTS ( object ):
             self.ppa_send = "resend"
             self.ppa_send_complete = "resend_complete"
 
+        # what we sent for this exposure before, and what did not change
+        # since; resends only need to send the rest
+        self.shipment_log = shipment_log
+        self.unchanged = {}
+        self.shipped_before = {}
+        self.delta_base = None
+        self.delta_number = 0
+        if (self.extra == "resend" and self.shipment_log is not None):
+            self.prepare_delta()
+
+        # wait until there is enough room in the scratch directory
+        self.scratch_manager = scratch_manager
+        if (self.scratch_manager is not None):
+            self.scratch_manager.reserve(self)
+
+        # the tar-prep directory is only needed when tar-ing up compressed
+        # files from disk, not when streaming fpack output into the tar-ball
+        if (self.packaging == 'files' and not os.path.isdir(self.tar_directory)):
+            self.logger.info("Creating tar-directory: %s" % (self.tar_directory))
+            os.mkdir(self.tar_directory)
+
         if (auto_start):
             self.archive()
 
+    def prepare_delta(self):
+        # Only send the files that changed since the last time this exposure
+        # was sent, together with a list of all unchanged files the archive
+        # has to take from the earlier tar-ball
+        previous = self.shipment_log.load(self.obsid)
+        if (previous is None):
+            self.logger.info("No record of sending this exposure before, re-sending all files")
+            return
+        unchanged = dts_delta.unchanged_members(self.manifest, previous)
+        if (len(unchanged) == 0):
+            return
+        if (len(unchanged) == len(self.manifest)):
+            # most likely the copy in the archive is missing or broken, so
+            # a delta would not help
+            self.logger.info("No files changed since the tar-ball with MD5=%s, re-sending all files" % (
+                previous['tar_checksum']))
+            return
+        self.unchanged = unchanged
+        self.shipped_before = previous['members']
+        self.delta_base = previous['tar_checksum']
+        # every delta gets its own name, so it does not replace an earlier
+        # one still waiting to be ingested
+        self.delta_number = previous.get('deltas', 0) + 1
+        self.filelist = [file_info for file_info in self.filelist if file_info[1] not in unchanged]
+        self.tar_filename = os.path.join(self.scratch_dir, self.dir_name)+".delta%d.tar" % (self.delta_number)
+        self.logger.info("Delta resend: %d of %d files changed since the tar-ball with MD5=%s" % (
+            len(self.filelist), len(self.manifest), self.delta_base))
+
+    def unchanged_md5_lines(self):
+        # md5.txt lines of the files left out of a delta resend, so md5.txt
+        # still describes the complete exposure
+        return ["%s %s" % (self.unchanged[entry.out_file], entry.out_file)
+                for entry in self.manifest.entries
+                if entry.out_file in self.unchanged and entry.include_md5]
+
+    def extra_members(self):
+        # (name, content) of all small text members besides md5.txt
+        members = []
+        if (self.extra_digest is not None):
+            members.append((self.extra_digest_filename(), "\n".join(self.extra_digest_lines())))
+        if (self.delta_base is not None):
+            members.append(("delta.txt", "\n".join(
+                ["# unchanged files from tar-ball MD5=%s" % (self.delta_base)] +
+                ["%s %s" % (self.unchanged[entry.out_file], entry.out_file)
+                 for entry in self.manifest.entries if entry.out_file in self.unchanged])))
+        return members
+
+    def record_member(self, out_file, md5):
+        with self.bytes_checksummed_lock:
+            self.member_md5[out_file] = md5
+
+    def record_shipment(self):
+        # remember what is in the archive now, for the next resend
+        if (self.delta_base is not None):
+            # later deltas are still made against the last complete tar-ball,
+            # as that is the only one the archive can take unchanged files from
+            self.shipment_log.save(self.obsid, self.delta_base, self.shipped_before,
+                                   deltas=self.delta_number)
+            return
+        members = {}
+        for entry in self.manifest.entries:
+            if (entry.out_file in self.member_md5):
+                members[entry.out_file] = dict(md5=self.member_md5[entry.out_file],
+                                               size=entry.size, mtime_ns=entry.mtime_ns)
+        self.shipment_log.save(self.obsid, self.tar_checksum, members)
+
     def update_obsid_from_files(self):
 
-        # open each of the files and search for the OBSID keyword
+        # search the headers of each of the files for the OBSID keyword
         print("Updating OBSID from data")
-        for (fn,_,_,_) in self.filelist:
-            with pyfits.open(fn) as hdulist:
-                # hdulist.info()
-                for ext in hdulist:
-                    if ('OBSID' in ext.header):
-                        self.obsid = ext.header['OBSID']
-                        #print("FOUND OBSID: %s" % (self.obsid))
-                        return
+        obsid = fits_header.find_keyword([fn for (fn,_,_,_) in self.filelist], 'OBSID',
+                                         index=self.header_index)
+        if (obsid is not None):
+            self.obsid = obsid
         return
 
 
     def archive(self):
-        all_steps_successful = False
+        # run all stages of the transfer, one after the other; if one of them
+        # fails, the report stage still marks the exposure as failed and
+        # cleans up
+        try:
+            self.compress_stage()
+            self.tar_stage()
+            self.transfer_stage()
+        except Exception as e:
+            self.logger.error(traceback.format_exc())
+            self.abort("Transferring %s failed: %s" % (self.obsid, str(e)))
+        if (self.verification is not None):
+            # report once the archive server checked the tar-ball, without
+            # holding up this worker
+            self.reported = self.verifier.report(self)
+            return
+        self.report_stage()
+
+    def compress_stage(self):
+        if (self.check_complete and not self.exposure_complete()):
+            self.tar_file_count = 0
+            return
+        # in streaming mode this already creates (and maybe sends) the tar-ball
+        start_time = time.time()
         self.ppa.report_exposure(obsid=self.obsid, msg_type=self.ppa_send,)
-        tar_file_count = self.make_tar()
-        if (tar_file_count < 0):
-            self.mark_as_tried_and_failed()
-            self.logger.error("Creating tar-file failed")
-        elif (tar_file_count == 0):
-            # this means there are no files to transfer
-            self.logger.warning("There are no files to transfer, marking this frame as complete !!!")
-            self.register_transfer_complete()
-            all_steps_successful = True
+        if (self.packaging == 'stream'):
+            self.tar_file_count = self.make_tar_stream()
         else:
-            if (self.transfer_to_archive()):
-                if (self.report_new_file_to_archive()):
-                    self.register_transfer_complete()
-                    self.logger.info("All successful")
-                    all_steps_successful = True
-                    self.ppa.report_exposure(obsid=self.obsid, msg_type=self.ppa_send_complete)
-                else:
-                    self.logger.error("reporting new exposure to PPA failed")
-            else:
-                self.logger.error("transfering to archive failed")
-        if (not all_steps_successful):
-            self.mark_as_tried_and_failed()
-            # TODO: ADD MORE INFO ABOUT ERROR
-            self.ppa.report_exposure(obsid=self.obsid, msg_type="error",
-                                     comment="Error during transport WIYN-->PPA. Check logs for now, detailed error message not yet implemented.")
+            self.tar_file_count = self.compress_files()
+        if (self.fz_cache is not None):
+            self.logger.info("Re-used %d compressed files from the fz cache" % (self.fz_cache_hits))
+        self.stage_times['compress'] = time.time() - start_time
+
+    def tar_stage(self):
+        if (self.error is None and self.packaging == 'files' and self.tar_file_count > 0):
+            start_time = time.time()
+            self.tar_file_count = self.create_tar()
+            self.stage_times['tar'] = time.time() - start_time
+
+    def transfer_stage(self):
+        if (self.error is None and self.tar_file_count > 0):
+            start_time = time.time()
+            self.transfer_successful = self.transfer_to_archive()
+            if (self.transfer_successful and self.verifier is not None and
+                    self.remote_checksum != self.tar_checksum):
+                # checked in the background, the report stage waits for it
+                self.verification = self.verifier.submit(self)
+            self.stage_times['transfer'] = time.time() - start_time
+
+    def report_stage(self):
+        try:
+            if (self.deferred is not None):
+                # nothing was sent, and nothing is reported; the exposure comes
+                # back once it is complete
+                self.logger.info("Deferring exposure: %s" % (self.deferred))
+                return
 
-        if (self.cleanup_when_complete):
-            self.cleanup_files()
+            all_steps_successful = False
+            tar_file_count = self.tar_file_count
+            if (self.error is not None):
+                self.logger.error(self.error)
+            elif (tar_file_count < 0):
+                self.mark_as_tried_and_failed()
+                self.logger.error("Creating tar-file failed")
+            elif (tar_file_count == 0):
+                # this means there are no files to transfer
+                self.logger.warning("There are no files to transfer, marking this frame as complete !!!")
+                self.register_transfer_complete()
+                all_steps_successful = True
+            else:
+                if (self.transfer_successful):
+                    self.report_successful = self.report_new_file_to_archive()
+                    if (self.report_successful):
+                        self.register_transfer_complete()
+                        if (self.shipment_log is not None):
+                            self.record_shipment()
+                        self.logger.info("All successful")
+                        all_steps_successful = True
+                        self.ppa.report_exposure(obsid=self.obsid, msg_type=self.ppa_send_complete)
+                    else:
+                        self.logger.error("tar-ball on archive server could not be verified")
+                else:
+                    self.logger.error("transfering to archive failed")
+            if (not all_steps_successful):
+                self.mark_as_tried_and_failed()
+                # TODO: ADD MORE INFO ABOUT ERROR
+                self.ppa.report_exposure(obsid=self.obsid, msg_type="error",
+                                         comment="Error during transport WIYN-->PPA. Check logs for now, detailed error message not yet implemented.")
+        finally:
+            # whatever happened, give back the scratch space
+            if (self.cleanup_when_complete):
+                self.cleanup_files()
+            if (self.scratch_manager is not None):
+                self.scratch_manager.release(self, keep=self.deferred is None and not self.cleanup_when_complete)
+
+    def abort(self, message):
+        # called when one of the stages failed unexpectedly; all remaining
+        # stages except the final report are skipped
+        self.error = message
+        if (self.stream_process is not None):
+            self.stream_process.kill()
+            self.stream_process.wait()
+            self.stream_process = None
 
     def get_filelist(self):
-        # Check all files in the directory - we need to collect all FITS files
-
-        self.filelist = []
-
-        # collect all FITS files
-        wildcards = os.path.join(self.exposure_directory, "*.fits")
-        fits_files = glob.glob(wildcards)
-        for ff in fits_files:
-            filesize = os.path.getsize(ff)
-            if (filesize <= 0):
-                self.logger.warning("Detected (and skipped) empty file: %s" % (ff))
+        # Check all files in the directory - we need to collect all FITS files,
+        # all expVideo files (these go in a sub-directory) and the metainf.xml.
+        # Sizes and modification times are kept in the manifest, so none of
+        # the later stages need to look at the files again
+        self.manifest = dts_manifest.scan_exposure(self.exposure_directory, logger=self.logger)
+        self.filelist = self.manifest.filelist()
+
+    def use_manifest(self, manifest):
+        # send the files of a newer scan of the exposure directory
+        self.manifest = manifest
+        self.filelist = manifest.filelist()
+        self.bytes_in = manifest.total_bytes
+        if (self.delta_base is not None):
+            # files changed since the first scan are no longer unchanged
+            self.unchanged = dts_delta.unchanged_members(manifest, dict(members=self.shipped_before))
+            self.filelist = [file_info for file_info in self.filelist if file_info[1] not in self.unchanged]
+
+    def find_incomplete_files(self):
+        # list of (filename, reason) of all files still being written, and
+        # the manifest of a second scan. Files modified within the last
+        # settle_time seconds have to stay the same for that long
+        fits_entries = [entry for entry in self.manifest.entries if entry.compress]
+        if (len(fits_entries) == 0):
+            return [], self.manifest
+        # mtimes on NFS can be ahead of our clock
+        wait_time = min(self.settle_time,
+                        self.settle_time - (time.time() - max([e.mtime_ns for e in fits_entries]) / 1e9))
+        if (wait_time > 0):
+            self.logger.info("Waiting %.1f seconds to make sure all files are written" % (wait_time))
+            time.sleep(wait_time)
+
+        # a second scan also finds files that were not there the first time
+        current = dts_manifest.scan_exposure(self.exposure_directory, logger=self.logger)
+        incomplete = []
+        for entry in current.entries:
+            if (not entry.compress):
                 continue
-            _,bn = os.path.split(os.path.abspath(ff))
-            self.filelist.append([os.path.abspath(ff), bn+".fz", True, True])
-
-        # collect all expVideo files - these go in a sub-directory
-        expvideo_files = glob.glob(
-            os.path.join(os.path.join(self.exposure_directory, "expVideo"), "*.fits")
-        )
-        for ff in expvideo_files:
-            filesize = os.path.getsize(ff)
-            if (filesize <= 0):
-                self.logger.warning("Detected (and skipped) empty file: %s" % (ff))
-                continue
-            _, bn = os.path.split(os.path.abspath(ff))
-            self.filelist.append([os.path.abspath(ff), os.path.join("expVideo", bn)+".fz", True, True])
-
-        metainf = os.path.join(self.exposure_directory, "metainf.xml")
-        if (os.path.isfile(metainf)):
-            # also include the metainf.xml
-            self.filelist.append([metainf, "metainf.xml", False, False])
-
-        # print("\n".join(fits_files))
-        # self.filelist = fits_files
+            before = self.manifest.get(entry.in_file)
+            if (before is None):
+                incomplete.append((entry.in_file, "new file"))
+            elif ((before.size, before.mtime_ns) != (entry.size, entry.mtime_ns)):
+                incomplete.append((entry.in_file, "still being written (%d -> %d bytes)" % (
+                    before.size, entry.size)))
+            else:
+                try:
+                    reason = fits_header.incomplete_reason(entry.in_file, entry.size)
+                except (IOError, OSError) as e:
+                    reason = str(e)
+                if (reason is not None):
+                    incomplete.append((entry.in_file, reason))
+        return incomplete, current
+
+    def exposure_complete(self):
+        # Check all files are completely written. If not, the exposure is
+        # deferred, unless the files have not changed in a long time
+        incomplete, current = self.find_incomplete_files()
+        if (len(incomplete) == 0):
+            return True
+        for (fn, reason) in incomplete:
+            self.logger.warning("%s is not complete: %s" % (fn, reason))
+
+        last_change = 0
+        for (fn, _) in incomplete:
+            try:
+                last_change = max(last_change, os.path.getmtime(fn))
+            except OSError:
+                pass
+        if (time.time() - last_change > self.incomplete_timeout):
+            self.logger.error("No changes to incomplete files for %d minutes, sending exposure as it is" % (
+                (time.time() - last_change) / 60))
+            # including files that showed up after the first scan
+            self.use_manifest(current)
+            return True
+        self.deferred = "%d file(s) not completely written yet" % (len(incomplete))
+        return False
 
     def make_tar(self):
 
-        # run fpack to enable compression on all image files
-        self.logger.info("Compressing data")
-        md5_data = []
-        for file_info in self.filelist: #fits_files:
-            #print(file_info)
-            (in_file, out_file, compress, include_md5) = file_info
-            if (compress):
-                dir,bn = os.path.split(out_file)
-                sub_directory = os.path.join(self.tar_directory, dir)
-                if (dir != '' and not os.path.isdir(sub_directory)):
-                    os.mkdir(sub_directory)
-                    self.cleanup_directories.append(sub_directory)
+        if (self.packaging == 'stream'):
+            return self.make_tar_stream()
 
-                fz_file, md5, returncode = self.fpack(in_file, out_file)
-                if (returncode != 0):
-                    return False
+        n_files = self.compress_files()
+        if (n_files <= 0):
+            return n_files
+        return self.create_tar()
 
-                self.logger.info("compressing %s to %s" % (in_file, out_file))
-                if (include_md5):
-                    md5_data.append("%s %s" % (md5, fz_file))
-                self.cleanup_filelist.append(os.path.join(self.tar_directory, out_file))
-            else:
-                full_out = os.path.join(self.tar_directory, out_file)
-                try:
-                    shutil.copy(in_file,full_out)
-                    self.logger.info("Copying %s to tar-prep directory" % (in_file))
-                    if (include_md5):
-                        md5 = self.calculate_checksum(full_out)
-                        md5_data.append("%s %s" % (md5, out_file))
-                except IOError as e:
-                    self.logger.error("I/O Error (%d) while copying %s: %s" % (e.errno, in_file, e.strerror))
-                    # likely caused by file-not-found
-                    pass
-                self.cleanup_filelist.append(full_out)
+    def compress_files(self):
 
-        if (len(md5_data) <= 0):
-            # no data here
-            return 0
+        # run fpack to enable compression on all image files
+        self.logger.info("Compressing data (%d files in parallel)" % (self.fpack_threads))
+
+        # create all sub-directories up-front so the worker threads never
+        # race each other trying to create the same directory
+        for (in_file, out_file, compress, include_md5) in self.filelist:
+            dir, bn = os.path.split(out_file)
+            sub_directory = os.path.join(self.tar_directory, dir)
+            if (dir != '' and not os.path.isdir(sub_directory)):
+                os.mkdir(sub_directory)
+                self.cleanup_directories.append(sub_directory)
+
+        # Compress all files of this exposure with a bounded pool of workers;
+        # results are collected in the order of the filelist to keep md5.txt
+        # identical to a sequential run
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.fpack_threads) as pool:
+            futures = [pool.submit(self.prepare_file, file_info) for file_info in self.filelist]
+            for future in concurrent.futures.as_completed(futures):
+                success, _ = future.result()
+                if (not success):
+                    # no need to compress any of the remaining files
+                    for f in futures:
+                        f.cancel()
+                    self.logger.error("Aborting compression after fpack failure")
+                    return -1
+
+        self.md5_data = [md5 for (_, md5) in [f.result() for f in futures] if md5 is not None]
+        self.md5_data += self.unchanged_md5_lines()
+        dts_staging.report(self.logger)
+
+        # no data here if there are no checksums
+        return len(self.md5_data)
+
+    def create_tar(self):
 
         # create the md5.txt file
         md5_filename = os.path.join(os.path.join(self.scratch_dir, self.dir_name),
                                     "md5.txt")
         # print(md5_data)
         with open(md5_filename, "w") as md5f:
-            md5f.write("\n".join(md5_data))
+            md5f.write("\n".join(self.md5_data))
         self.cleanup_filelist.append(md5_filename)
 
+        extra_members = self.extra_members()
+        for (name, content) in extra_members:
+            extra_filename = os.path.join(self.tar_directory, name)
+            with open(extra_filename, "w") as f:
+                f.write(content)
+            self.cleanup_filelist.append(extra_filename)
+
         # Now create the actual tar ball
-        file_glob = os.path.join(os.path.join(self.scratch_dir, self.dir_name), "*")
-        n_files = len(glob.glob(file_glob))
-        self.logger.info("Making tar ball (%s) from %d files (%s)" % (self.tar_filename, n_files, file_glob))
-        tar_cmd = "tar --create --seek --file=%s --directory=%s %s" % (
-            self.tar_filename, self.scratch_dir, self.dir_name)
+        n_files = len(self.prepared_files) + 1 + len(extra_members)
+        self.logger.info("Making tar ball (%s) from %d files (%s)" % (self.tar_filename, n_files, self.tar_directory))
+        # tar writes to stdout, so we can checksum the tar-ball while writing it
+        tar_cmd = "tar --create --file=- --directory=%s %s" % (
+            self.scratch_dir, self.dir_name)
         # print(tar_cmd)
-        returncode = self.execute(tar_cmd)
+        with self.hashing_writer(open(self.tar_filename, "wb")) as tar_writer:
+            returncode = self.execute(tar_cmd, redirect_stdout=tar_writer)
         if (returncode != 0):
             return -1
         #--remove-files
 
-        self.tar_checksum = self.calculate_checksum(self.tar_filename)
-        self.tar_filesize = os.path.getsize(self.tar_filename)
-        self.logger.info("Resulting tar-ball: %d bytes, MD5=%s" % (self.tar_filesize, self.tar_checksum))
-        # print(self.tar_checksum)
+        self.set_tar_checksum(tar_writer)
+
+        return n_files
+
+    def make_tar_stream(self):
+
+        # Write the tar-ball directly from the fpack output, without writing
+        # any of the compressed files to the tar-prep directory first
+        self.logger.info("Compressing data straight into tar-ball %s (%d files in parallel)" % (
+            self.tar_filename if self.transfer_protocol != 'stream' else self.remote_target_directory,
+            self.fpack_threads))
+
+        tar_writer = self.hashing_writer(self.open_tar_output())
+        try:
+            with tarfile.open(fileobj=tar_writer, mode="w", format=tarfile.GNU_FORMAT) as tar:
+                n_files = self.write_tar_stream(tar)
+            if (n_files > 0):
+                tar_writer.close()
+        except (IOError, OSError) as e:
+            # this includes the ssh connection dying on us while streaming
+            self.logger.error("Error writing tar-ball: %s" % (str(e)))
+            n_files = -1
+
+        if (n_files <= 0):
+            self.discard_tar_output(tar_writer)
+            return n_files
+
+        self.logger.info("Wrote %d files to tar-ball" % (n_files))
+        self.set_tar_checksum(tar_writer)
+
+        return n_files
+
+    def open_tar_output(self):
+
+        if (self.transfer_protocol != 'stream'):
+            return open(self.tar_filename, "wb")
+
+        # Send the tar-ball straight to the archive through a ssh pipe. It is
+        # written to a temporary name first and only renamed once complete
+        remote_server, remote_directory = self.remote_target_directory.split(":", 1)
+        self.remote_tar_filename = os.path.join(remote_directory, os.path.basename(self.tar_filename))
+        cmd = self.ssh_command() + [
+            remote_server, "cat > %s" % (shlex.quote(self.remote_tar_filename+".part"))]
+        self.logger.info("Streaming tar-ball to archive (%s)" % (" ".join(cmd)))
+        self.stream_start_time = time.time()
+        self.stream_process = dts_supervisor.SupervisedProcess(
+            cmd, stdin=True, timeout=self.transfer_timeout, logger=self.logger).start()
+        return self.stream_process.stdin
+
+    def discard_tar_output(self, tar_writer):
+        # abort an incomplete tar-ball; when streaming, the remote side is
+        # never renamed to its final name
+        if (self.stream_process is not None):
+            self.stream_process.kill()
+            self.stream_process.wait()
+            self.stream_process = None
+        try:
+            tar_writer.close()
+        except (IOError, OSError):
+            pass
+
+    def ssh_command(self, multiplex=True):
+        cmd = ["ssh"]
+        if (not multiplex):
+            # we want a TCP connection of our own
+            cmd += ["-o", "ControlPath=none"]
+        elif (self.ssh_pool is not None):
+            # re-use one of the open connections to the archive
+            remote_server, _ = self.remote_target_directory.split(":", 1)
+            cmd += self.ssh_pool.ssh_options(remote_server)
+        if (self.sshkey is not None):
+            cmd += ["-i", self.sshkey]
+        return cmd
+
+    def write_tar_stream(self, tar):
+
+        n_files = 0
+        md5_data = [None] * len(self.filelist)
+
+        # add the directory entries, just like tar does for the tar-prep directory
+        directories = [self.dir_name] + sorted(set(
+            [os.path.join(self.dir_name, os.path.dirname(out_file))
+             for (_, out_file, _, _) in self.filelist if os.path.dirname(out_file) != '']))
+        for dir in directories:
+            tarinfo = tarfile.TarInfo(dir)
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = 0o755
+            tarinfo.mtime = time.time()
+            tar.addfile(tarinfo)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.fpack_threads) as pool:
+            # compressed files wait in their spools until they are added to
+            # the tar-ball, so only compress a few files ahead of it; this
+            # keeps the memory used to max_pending spools
+            max_pending = 2 * self.fpack_threads
+            to_submit = iter(enumerate(self.filelist))
+            futures = {}
+            try:
+                while (True):
+                    for idx, file_info in to_submit:
+                        futures[pool.submit(self.prepare_file_stream, file_info)] = idx
+                        if (len(futures) >= max_pending):
+                            break
+                    if (len(futures) == 0):
+                        break
+
+                    # only this thread writes to the tar-ball; members are added in
+                    # the order the compression completes
+                    done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        idx = futures.pop(future)
+                        (in_file, out_file, compress, include_md5) = self.filelist[idx]
+                        success, md5, spool = future.result()
+                        if (not success):
+                            self.logger.error("Aborting compression after fpack failure")
+                            return -1
+                        if (spool is None):
+                            # file was skipped
+                            continue
+
+                        tarinfo = tarfile.TarInfo(os.path.join(self.dir_name, out_file))
+                        tarinfo.mode = 0o644
+                        tarinfo.mtime = time.time()
+                        with spool:
+                            tarinfo.size = spool.seek(0, io.SEEK_END)
+                            spool.seek(0)
+                            tar.addfile(tarinfo, spool)
+                        n_files += 1
+                        self.record_member(out_file, md5)
+                        if (include_md5):
+                            md5_data[idx] = "%s %s" % (md5, out_file)
+            finally:
+                # if we gave up half-way, close what was prepared for the
+                # members that never made it into the tar-ball
+                for future in futures:
+                    if (future.cancel()):
+                        continue
+                    try:
+                        _, _, spool = future.result()
+                    except Exception:
+                        continue
+                    if (spool is not None):
+                        spool.close()
+
+        md5_data = [md5 for md5 in md5_data if md5 is not None] + self.unchanged_md5_lines()
+        if (len(md5_data) <= 0):
+            # no data here
+            return 0
+
+        for (name, content) in self.extra_members():
+            extra_bytes = content.encode('ascii')
+            tarinfo = tarfile.TarInfo(os.path.join(self.dir_name, name))
+            tarinfo.mode = 0o644
+            tarinfo.mtime = time.time()
+            tarinfo.size = len(extra_bytes)
+            tar.addfile(tarinfo, io.BytesIO(extra_bytes))
+            n_files += 1
+
+        # md5.txt is the last member, as it needs the checksums of all others
+        md5_bytes = "\n".join(md5_data).encode('ascii')
+        tarinfo = tarfile.TarInfo(os.path.join(self.dir_name, "md5.txt"))
+        tarinfo.mode = 0o644
+        tarinfo.mtime = time.time()
+        tarinfo.size = len(md5_bytes)
+        tar.addfile(tarinfo, io.BytesIO(md5_bytes))
+        n_files += 1
 
         return n_files
 
+    def prepare_file_stream(self, file_info):
+        # Compress one file into a spooled buffer (or open it, if it is not
+        # compressed), ready to be added to the tar-ball. Returns success, md5
+        # and the file object (None if skipped)
+        (in_file, out_file, compress, include_md5) = file_info
+        if (compress):
+            cached = self.lookup_fz_cache(in_file)
+            if (cached is not None):
+                _, fz, md5 = cached
+                self.logger.info("Using cached %s for %s" % (out_file, in_file))
+                self.record_extra_digest(out_file, fz)
+                return True, md5, fz
+
+        if (not compress):
+            # tar reads straight from the source file, no need to copy it
+            try:
+                staged = dts_staging.hash_file(in_file, extra_algorithms=self.extra_algorithms())
+                source = open(in_file, "rb")
+                self.logger.info("Adding %s to tar-ball" % (in_file))
+            except IOError as e:
+                self.logger.error("I/O Error (%d) while reading %s: %s" % (e.errno, in_file, e.strerror))
+                # likely caused by file-not-found
+                return True, None, None
+            if (include_md5):
+                self.count_checksummed_bytes(staged)
+                self.record_extra_digest(out_file, staged)
+            return True, staged.hexdigest(), source
+
+        spool = tempfile.SpooledTemporaryFile(max_size=self.stream_spool_size, dir=self.scratch_dir)
+        writer = self.hashing_writer(spool)
+        returncode = self.compressor.compress(in_file, writer)
+        if (returncode != 0):
+            self.logger.error("%s failed (%d) for %s" % (self.compressor.name, returncode, in_file))
+            spool.close()
+            return False, None, None
+        self.logger.info("compressing %s to %s" % (in_file, out_file))
+        if (self.fz_cache is not None):
+            spool.seek(0)
+            self.fz_cache.store(self.fz_cache_key(in_file), spool, writer.hexdigest())
+
+        md5 = None
+        if (include_md5):
+            self.count_checksummed_bytes(writer)
+            self.record_extra_digest(out_file, writer)
+            md5 = writer.hexdigest()
+        return True, md5, spool
+
+    def prepare_file(self, file_info):
+        # Compress (or copy) one file into the tar-prep directory. Returns a
+        # tuple of success and the md5.txt line for this file (or None)
+        (in_file, out_file, compress, include_md5) = file_info
+        md5_line = None
+        if (compress):
+            full_out = os.path.join(self.tar_directory, out_file)
+            self.cleanup_filelist.append(full_out)
+            if (self.fz_cache is not None and os.path.lexists(full_out)):
+                # this might be a hard link into the cache, never write through it
+                os.remove(full_out)
+            cached = self.lookup_fz_cache(in_file)
+            if (cached is not None):
+                cached_file, fz, md5 = cached
+                fz_file = out_file
+                with fz:
+                    try:
+                        os.link(cached_file, full_out)
+                    except OSError:
+                        # also if the entry was evicted in the meantime
+                        with open(full_out, "wb") as f:
+                            shutil.copyfileobj(fz, f)
+                self.logger.info("Using cached %s for %s" % (out_file, in_file))
+                self.record_extra_digest(out_file, full_out)
+                self.prepared_files.append(out_file)
+            else:
+                fz_file, md5, returncode = self.fpack(in_file, out_file)
+                if (returncode != 0):
+                    self.logger.error("%s failed (%d) for %s" % (self.compressor.name, returncode, in_file))
+                    return False, None
+
+                self.logger.info("compressing %s to %s" % (in_file, out_file))
+                self.prepared_files.append(out_file)
+                if (self.fz_cache is not None):
+                    self.fz_cache.store(self.fz_cache_key(in_file), full_out, md5)
+            self.record_member(out_file, md5)
+            if (include_md5):
+                md5_line = "%s %s" % (md5, fz_file)
+        else:
+            full_out = os.path.join(self.tar_directory, out_file)
+            self.cleanup_filelist.append(full_out)
+            try:
+                # reflink, hard link or in-kernel copy where possible
+                staged = dts_staging.stage_file(in_file, full_out, extra_algorithms=self.extra_algorithms())
+                self.logger.info("Copying %s to tar-prep directory (%s)" % (in_file, staged.method))
+                self.prepared_files.append(out_file)
+                self.record_member(out_file, staged.hexdigest())
+                if (include_md5):
+                    self.count_checksummed_bytes(staged)
+                    self.record_extra_digest(out_file, staged)
+                    md5_line = "%s %s" % (staged.hexdigest(), out_file)
+            except IOError as e:
+                self.logger.error("I/O Error (%d) while copying %s: %s" % (e.errno, in_file, e.strerror))
+                # likely caused by file-not-found
+                pass
+        return True, md5_line
+
     def fpack(self, filename, outfile):
         #_, basename = os.path.split(filename)
         #fz_filename = basename+".fz"
@@ -255,42 +832,257 @@ class DTS ( object ):
         # # print(cmd)
         # returncode = self.execute(cmd, monitor=False)
 
-        cmd = "fpack -S %s" % (filename)
-        returncode = self.execute(cmd, monitor=False, redirect_stdout=fz_filename_full)
-
-        checksum = self.calculate_checksum(fz_filename_full)
-        return outfile, checksum, returncode
+        with self.hashing_writer(open(fz_filename_full, "wb")) as fz_writer:
+            returncode = self.compressor.compress(filename, fz_writer)
+        self.count_checksummed_bytes(fz_writer)
+        self.record_extra_digest(outfile, fz_writer)
+
+        return outfile, fz_writer.hexdigest(), returncode
+
+    def fz_cache_key(self, in_file):
+        # size and modification time from the manifest, to save a stat
+        entry = self.manifest.get(in_file)
+        return self.fz_cache.key(in_file, self.compressor.settings(),
+                                 stat=(entry.size, entry.mtime_ns) if entry is not None else None)
+
+    def lookup_fz_cache(self, in_file):
+        if (self.fz_cache is None):
+            return None
+        if (self.precompressor is not None):
+            # this file might be getting compressed ahead of time right now
+            self.precompressor.wait_for(in_file)
+        cached = self.fz_cache.open(self.fz_cache_key(in_file))
+        if (cached is not None):
+            # the checksum lock also protects this counter
+            with self.bytes_checksummed_lock:
+                self.fz_cache_hits += 1
+        return cached
+
+    def extra_algorithms(self):
+        return (self.extra_digest,) if self.extra_digest is not None else ()
+
+    def hashing_writer(self, fileobj):
+        # computes the MD5 and, if requested, the extra digest while writing
+        return dts_checksum.HashingWriter(fileobj, extra_algorithms=self.extra_algorithms())
+
+    def record_extra_digest(self, out_file, source):
+        # source is a HashingWriter, a StagedFile, or the name of a file (or
+        # an open file) to read
+        if (self.extra_digest is None):
+            return
+        if (isinstance(source, str)):
+            digest = dts_checksum.file_checksum(source, self.extra_digest)
+        elif (hasattr(source, "read")):
+            digest = dts_checksum.fileobj_checksums(source, (self.extra_digest,))[0]
+            source.seek(0)
+        else:
+            digest = source.extra_hexdigests()[self.extra_digest]
+        with self.bytes_checksummed_lock:
+            self.extra_digests[out_file] = digest
+
+    def extra_digest_filename(self):
+        return "%s.txt" % (self.extra_digest)
+
+    def extra_digest_lines(self):
+        # same order and format as md5.txt
+        return ["%s %s" % (self.extra_digests[out_file], out_file)
+                for (_, out_file, _, include_md5) in self.filelist
+                if include_md5 and out_file in self.extra_digests]
+
+    def count_checksummed_bytes(self, writer):
+        with self.bytes_checksummed_lock:
+            self.bytes_checksummed += writer.bytes_written
+
+    def set_tar_checksum(self, tar_writer):
+        self.count_checksummed_bytes(tar_writer)
+        self.tar_checksum = tar_writer.hexdigest()
+        self.tar_filesize = tar_writer.bytes_written
+        self.logger.info("Resulting tar-ball: %d bytes, MD5=%s" % (self.tar_filesize, self.tar_checksum))
+        if (self.extra_digest is not None):
+            self.tar_extra_digest = tar_writer.extra_hexdigests()[self.extra_digest]
+            self.logger.info("Tar-ball %s=%s" % (self.extra_digest, self.tar_extra_digest))
+        self.logger.info("Checksummed %d bytes while writing them (saved reading them back)" % (
+            self.bytes_checksummed))
 
     def transfer_to_archive(self):
 
+        if (self.transfer_protocol == 'stream'):
+            # all data was already sent while making the tar-ball
+            returncode = self.finish_stream_transfer()
+            start_time = self.stream_start_time
+            end_time = time.time()
+            self.tar_transfer_time = end_time - start_time
+            self.transfer_result = dts_transport.TransferResult(
+                returncode == 0, self.tar_filesize, self.tar_transfer_time, method='stream')
+            self.logger.info("Done with streaming transfer, time=%.1f seconds, bandwidth: %d bytes/sec" % (
+                self.tar_transfer_time, self.tar_filesize//self.tar_transfer_time
+            ))
+            return (returncode == 0)
+
+        use_multistream = (
+            self.transfer_streams > 1 and self.tar_filesize >= self.MULTISTREAM_MIN_SIZE and
+            self.transfer_protocol in ['rsync', 'scp'] and
+            ':' in self.remote_target_directory and self.bandwidth_limit is None)
+
+        use_bundle = (not use_multistream and self.bundler is not None and self.bundler.accepts(self))
+
+        for attempt in range(self.transfer_retries + 1):
+            if (attempt > 0):
+                delay = min(60., 5. * 2**(attempt-1))
+                self.logger.warning("Transfer failed, trying again in %.0f seconds (retry %d of %d)" % (
+                    delay, attempt, self.transfer_retries))
+                time.sleep(delay)
+            result = None
+            if (use_multistream):
+                result = self.transfer_multistream()
+            elif (use_bundle and attempt == 0):
+                # small tar-balls share a single transfer with other exposures;
+                # retries go out on their own
+                result = self.transfer_bundled()
+            if (result is None):
+                result = self.transport.send(self, [self.tar_filename])
+            result.retries = attempt
+            if (result.success):
+                break
+        self.transfer_result = result
+        self.tar_transfer_time = result.duration
+        self.logger.info("Done with transfer, time=%.1f seconds, bandwidth: %d bytes/sec" % (
+            result.duration, result.bandwidth()
+        ))
+        return result.success
+
+
+    def transfer_bundled(self):
+        # TransferResult, or None if the bundle failed and the tar-ball has
+        # to be sent on its own right away
+        bundle_successful = self.bundler.transfer(self)
+        if (bundle_successful is None):
+            return None
+        return dts_transport.TransferResult(
+            bundle_successful, self.tar_filesize if bundle_successful else 0,
+            self.tar_transfer_time if bundle_successful else 0., method=self.transfer_protocol)
+
+    def transfer_multistream(self):
+
+        # Send the tar-ball in byte ranges over several parallel ssh
+        # connections, then join the parts on the archive server and check
+        # the result against our checksum. Returns a TransferResult
+        remote_server, remote_directory = self.remote_target_directory.split(":", 1)
+        remote_tar = os.path.join(remote_directory, os.path.basename(self.tar_filename))
+        part_size = -(-self.tar_filesize // self.transfer_streams)
+        parts = []
+        for idx in range(self.transfer_streams):
+            offset = idx * part_size
+            if (offset < self.tar_filesize):
+                parts.append(("%s.part%d" % (remote_tar, idx), offset, min(part_size, self.tar_filesize - offset)))
+
+        self.logger.info("Copying to archive in %d parallel streams of %.1f MB" % (len(parts), part_size/2**20))
+        start_time = time.time()
+        method = "ssh x%d" % (len(parts))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(parts)) as pool:
+            results = list(pool.map(lambda part: self.send_part(remote_server, *part), parts))
+
+        part_names = " ".join([shlex.quote(name) for (name, _, _) in parts])
+        if (all(results)):
+            # join the parts, and only give the tar-ball its final name if it
+            # is identical to ours
+            quoted_tar = shlex.quote(remote_tar)
+            cmd = self.ssh_command() + [remote_server,
+                "cat %s > %s.part && rm -f %s && md5sum %s.part" % (part_names, quoted_tar, part_names, quoted_tar)]
+            result = dts_supervisor.run(cmd, timeout=self.transfer_timeout, logger=self.logger)
+            remote_checksum = result.stdout.decode('ascii', 'replace').split(" ")[0].strip()
+            if (result.returncode != 0):
+                self.logger.error("Joining parts on archive server failed (%d)" % (result.returncode))
+                remote_checksum = None
+            elif (remote_checksum != self.tar_checksum):
+                self.logger.error("Checksum of joined tar-ball (%s) does not match ours (%s)" % (
+                    remote_checksum, self.tar_checksum))
+            else:
+                self.logger.info("Checksum of joined tar-ball verified: %s" % (remote_checksum))
+                # no need to check it again
+                self.remote_checksum = remote_checksum
+                returncode = self.execute(self.ssh_command() + [remote_server, "mv %s.part %s" % (quoted_tar, quoted_tar)])
+                if (returncode == 0):
+                    return dts_transport.TransferResult(
+                        True, self.tar_filesize, time.time() - start_time, method=method)
+
+        # leave nothing behind that might be mistaken for a complete tar-ball
+        self.execute(self.ssh_command() + [remote_server, "rm -f %s %s" % (
+            part_names, shlex.quote(remote_tar+".part"))])
+        return dts_transport.TransferResult(False, 0, time.time() - start_time, method=method)
+
+    def send_part(self, remote_server, remote_name, offset, length):
+        cmd = self.ssh_command(multiplex=False) + [remote_server, "cat > %s" % (shlex.quote(remote_name))]
+        process = dts_supervisor.SupervisedProcess(
+            cmd, stdin=True, timeout=self.transfer_timeout, logger=self.logger).start()
+        try:
+            with open(self.tar_filename, "rb") as f:
+                f.seek(offset)
+                while (length > 0):
+                    block = f.read(min(length, 2**20))
+                    if (len(block) == 0):
+                        raise IOError("%s is shorter than expected" % (self.tar_filename))
+                    process.stdin.write(block)
+                    length -= len(block)
+            process.stdin.close()
+        except (IOError, OSError) as e:
+            self.logger.error("Error sending %s: %s" % (remote_name, str(e)))
+            process.kill()
+        result = process.wait()
+        if (result.returncode != 0 or length > 0):
+            self.logger.error("Sending %s failed (%d)" % (remote_name, result.returncode))
+            return False
+        return True
+
+    def transfer_command(self, tar_filenames):
+        ssh_cmd = self.ssh_command() if ':' in self.remote_target_directory else ["ssh"]
         if (self.transfer_protocol == 'scp'):
-            cmd = "scp %s %s" % (self.tar_filename, self.remote_target_directory)
+            cmd = ["scp"] + ssh_cmd[1:]
+            if (self.bandwidth_limit is not None):
+                # scp wants Kbit/s
+                cmd += ["-l", "%d" % (8 * self.bandwidth_limit)]
+            cmd += tar_filenames + [self.remote_target_directory]
         elif (self.transfer_protocol == 'rsync'):
-            cmd = "rsync -rvu --progress %s %s" % (self.tar_filename, self.remote_target_directory)
+            cmd = ["rsync", "-rvu", "--progress"]
+            if (self.bandwidth_limit is not None):
+                cmd += ["--bwlimit=%d" % (self.bandwidth_limit)]
+            if (len(ssh_cmd) > 1):
+                cmd += ["-e", " ".join(ssh_cmd)]
+            cmd += tar_filenames + [self.remote_target_directory]
             # cmd = "rsync -avu --progress %s %s" % (self.tar_filename, self.remote_target_directory)
         else:
             raise ValueError("Could not identfy which transfer protocal to use")
+        return cmd
 
-        self.logger.info("Copying to archive using %s (%s)" % (self.transfer_protocol, cmd))
-        # print(cmd)
-        start_time = time.time()
-        returncode = self.execute(cmd)
-        end_time = time.time()
-        self.tar_transfer_time = end_time - start_time
-        self.logger.info("Done with transfer, time=%.1f seconds, bandwidth: %d bytes/sec" % (
-            self.tar_transfer_time, self.tar_filesize//self.tar_transfer_time
-        ))
-        return (returncode == 0)
+    def finish_stream_transfer(self):
+
+        # stdin was already closed when finishing the tar-ball
+        result = self.stream_process.wait()
+        self.stream_process = None
+        if (result.returncode != 0):
+            self.logger.error("Streaming tar-ball to archive failed (%d)" % (result.returncode))
+            self.logger.debug("Stderr=\n"+str(result.stderr))
+            return result.returncode
 
+        remote_server, _ = self.remote_target_directory.split(":", 1)
+        cmd = self.ssh_command() + [remote_server, "mv %s %s" % (
+            shlex.quote(self.remote_tar_filename+".part"), shlex.quote(self.remote_tar_filename))]
+        return self.execute(cmd)
 
     def register_transfer_complete(self):
         # print("Marking as complete")
         extra_formatted = '' if self.extra is None else "%s " % (self.extra)
+        result = self.transfer_result
+        if (result is None):
+            # nothing was sent
+            result = dts_transport.TransferResult(True, self.tar_filesize, self.tar_transfer_time,
+                                                  method=self.transfer_protocol)
+        method = result.method if result.retries == 0 else "%s, retries=%d" % (result.method, result.retries)
         event = "pyDTS %s%s: fpack(%d) - tar(%5.1fMB, MD5=%s) - transfer(%4.1fs @ %5.2fMB/s via %s) - upload(%s): OK :: 0" % (
             extra_formatted, self.obsid,
             len(self.filelist), self.tar_filesize/2**20, self.tar_checksum,
-            self.tar_transfer_time, self.tar_filesize/2**20/self.tar_transfer_time,
-            self.transfer_protocol, self.remote_target_directory,
+            result.duration, result.bandwidth()/2**20,
+            method, self.remote_target_directory,
         )
         self.database.mark_exposure_archived(self.obsid, event=event)
         self.logger.info("Adding event to database: %s" % (event))
@@ -305,93 +1097,64 @@ class DTS ( object ):
         self.logger.info("Adding event to database: %s" % (event))
 
 
-    def execute(self, cmd, monitor=True, redirect_stdout=None):
-        try:
-            stdout = subprocess.PIPE
-            if (redirect_stdout is not None):
-                stdout = open(redirect_stdout, "wb")
-            ret = subprocess.Popen(cmd.split(),
-                                   stdout=stdout,
-                                   stderr=subprocess.PIPE)
-
-            if (monitor):
-                #
-                # Wait for sextractor to finish (or die)
-                #
-                ps = psutil.Process(ret.pid)
-                execution_error = False
-                while(True):
-                    try:
-                        ps_status = ps.status()
-                        if (ps_status in [psutil.STATUS_ZOMBIE,
-                                          psutil.STATUS_DEAD] and
-                            ret.poll() is not None):
-                            self.logger.critical("Command died unexpectedly (%s ==> %s)" % (
-                                cmd, str(ps_status)))
-                            execution_error = True
-                            break
-                    except psutil.NoSuchProcess:
-                        pass
-
-                    if (ret.poll() is None):
-                        # self.logger.debug("Command completed successfully!")
-                        break
-                    time.sleep(0.05)
-            else:
-                execution_error = False
-
-            if (not execution_error):
-                (cmd_stdout, cmd_stderr) = ret.communicate()
-                if (ret.returncode != 0):
-                    self.logger.warning("Command might have a problem, check the log")
-                    self.logger.debug("Stdout=\n"+str(cmd_stdout))
-                    self.logger.debug("Stderr=\n"+str(cmd_stderr))
+    def execute(self, cmd, redirect_stdout=None, timeout=None):
 
+        # redirect_stdout can be a filename or any file-like object
+        stdout_file = None
+        if (redirect_stdout is not None and not hasattr(redirect_stdout, "write")):
+            stdout_file = open(redirect_stdout, "wb")
+            redirect_stdout = stdout_file
+        try:
+            result = dts_supervisor.run(cmd, stdout=redirect_stdout, timeout=timeout,
+                                        logger=self.logger)
         except OSError as e:
             self.logger.critical("Execution failed: %s" % (str(e)))
-        end_time = time.time()
-
-        # logger.debug("SourceExtractor returned after %.3f seconds" % (end_time - start_time))
+            return -1
+        finally:
+            if (stdout_file is not None):
+                stdout_file.close()
 
-        if (redirect_stdout is not None):
-            stdout.close()
+        if (result.returncode != 0):
+            self.logger.warning("Command might have a problem, check the log")
+            self.logger.debug("Stdout=\n"+str(result.stdout))
+            self.logger.debug("Stderr=\n"+str(result.stderr))
 
-        # os.system(cmd)
-        return ret.returncode
+        return result.returncode
 
 
     def calculate_checksum(self, fn):
+        return dts_checksum.file_checksum(fn)
 
-        # from https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
-        def hash_bytestr_iter(bytesiter, hasher, ashexstr=False):
-            for block in bytesiter:
-                hasher.update(block)
-            return hasher
-        def file_as_blockiter(afile, blocksize=65536):
-            with afile:
-                block = afile.read(blocksize)
-                while len(block) > 0:
-                    yield block
-                    block = afile.read(blocksize)
-        checksum = hash_bytestr_iter(file_as_blockiter(open(fn, 'rb')),
-                                     hashlib.md5())
-        # print("MD5v1:", checksum.hexdigest())
-        # checksum = hashlib.md5(open(fn, 'rb').read()).hexdigest()
-        return checksum.hexdigest()
-
-        # [(fname, hash_bytestr_iter(file_as_blockiter(open(fname, 'rb')), hashlib.md5()))
-        #  for fname in fnamelst]
+    def remote_tar_location(self):
+        # server (None for local copies) and path of the tar-ball on the archive server
+        remote_name = os.path.basename(self.tar_filename)
+        if (self.transfer_protocol == 'local' or ':' not in self.remote_target_directory):
+            return None, os.path.join(self.remote_target_directory.split(":", 1)[-1], remote_name)
+        remote_server, remote_directory = self.remote_target_directory.split(":", 1)
+        return remote_server, os.path.join(remote_directory, remote_name)
 
     def report_new_file_to_archive(self):
-        return True
+        # the tar-ball only counts as delivered once the archive server has
+        # an identical copy
+        if (self.verification is None):
+            return True
+        start_time = time.time()
+        try:
+            verified = self.verification.result(timeout=self.verifier.result_timeout())
+        except concurrent.futures.TimeoutError:
+            self.logger.error("No checksum from archive server after %.0f seconds" % (time.time() - start_time))
+            verified = False
+        self.stage_times['verify'] = time.time() - start_time
+        return verified
 
     def cleanup_files(self):
 
         # first, delete all files
         for fn in self.cleanup_filelist:
             try:
-                if (os.path.isfile(fn)):
-                    os.remove(fn)
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
             except OSError:
                 self.logger.error("ERROR deleting file %s" % fn)
 
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import tempfile
+import concurrent.futures
+
+import commandline
+import config
+import dts_checksum
+import dts_compress
+import dts_supervisor
+
+
+class NullWriter(object):
+    # discard all output, we only want to measure the time it takes to create it
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def execute(cmd, redirect_stdout=None):
+    # minimal version of DTS.execute, only good for compressing files
+    return dts_supervisor.run(cmd, stdout=redirect_stdout).returncode
+
+
+def benchmark_compressors(filenames, compressor_names):
+
+    print("%-10s %10s %10s %7s %10s" % ("compressor", "in [MB]", "out [MB]", "ratio", "MB/s"))
+    for name in compressor_names:
+        compressor = dts_compress.get_compressor(name, execute=execute)
+        bytes_in = 0
+        bytes_out = 0
+        start_time = time.time()
+        for fn in filenames:
+            writer = dts_checksum.HashingWriter(NullWriter())
+            if (compressor.compress(fn, writer) != 0):
+                print("%s failed to compress %s" % (name, fn))
+                continue
+            bytes_in += os.path.getsize(fn)
+            bytes_out += writer.bytes_written
+        run_time = time.time() - start_time
+        print("%-10s %10.1f %10.1f %7.2f %10.1f" % (
+            name, bytes_in/2**20, bytes_out/2**20,
+            bytes_in/bytes_out if bytes_out > 0 else 0,
+            bytes_in/2**20/run_time))
+
+
+def benchmark_checksums(filenames, algorithms, blocksizes, n_threads, scratch_dir):
+
+    remove_files = []
+    if (len(filenames) == 0):
+        # without files to test on, create one on the scratch disk
+        fd, fn = tempfile.mkstemp(dir=scratch_dir, suffix=".bench")
+        with os.fdopen(fd, "wb") as f:
+            for i in range(256):
+                f.write(os.urandom(2**20))
+        filenames = [fn]
+        remove_files.append(fn)
+    total_bytes = sum([os.path.getsize(fn) for fn in filenames])
+
+    # read everything once, so all runs see the same (cached) state
+    for fn in filenames:
+        dts_checksum.file_checksum(fn)
+
+    print("%-10s %12s %10s" % ("algorithm", "buffer", "MB/s"))
+    for algorithm in algorithms:
+        for blocksize in blocksizes:
+            for use_mmap in [False, True]:
+                start_time = time.time()
+                for fn in filenames:
+                    dts_checksum.file_checksum(fn, algorithm, blocksize=blocksize, use_mmap=use_mmap)
+                run_time = time.time() - start_time
+                print("%-10s %12s %10.1f" % (
+                    algorithm, "%dk%s" % (blocksize//1024, " mmap" if use_mmap else ""),
+                    total_bytes/2**20/run_time))
+
+        if (len(filenames) > 1):
+            start_time = time.time()
+            # independent files in parallel, one per thread
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, n_threads)) as pool:
+                list(pool.map(lambda fn: dts_checksum.file_checksum(fn, algorithm), filenames))
+            run_time = time.time() - start_time
+            print("%-10s %12s %10.1f" % (algorithm, "%d threads" % (n_threads), total_bytes/2**20/run_time))
+
+    for fn in remove_files:
+        os.remove(fn)
+
+
+if __name__ == "__main__":
+
+    special_options = [
+        (['--compressors'], dict(dest='compressors', type=str, default="fpack,astropy",
+                                 help="comma-separated list of compressors to benchmark")),
+        (['--algorithms'], dict(dest='algorithms', type=str, default="md5,sha1,blake2b,blake2s",
+                                help="comma-separated list of checksum algorithms to benchmark")),
+        (['--blocksizes'], dict(dest='blocksizes', type=str, default="64,1024,4096,16384",
+                                help="comma-separated list of read buffer sizes in KB to benchmark")),
+    ]
+
+    args = commandline.parse(special_options, epilog="""\
+
+  Benchmarks for the DTS building blocks:
+
+  compress <file.fits> ...   compare throughput and compression ratio of all
+                             compressors (--compressors) on the given files
+
+  checksum [<file> ...]      throughput of all checksum algorithms
+                             (--algorithms) and read buffer sizes
+                             (--blocksizes), with and without mmap, and of
+                             hashing the files in parallel (--fpackthreads);
+                             uses a 256 MB file in the scratch directory if
+                             no files are given
+
+""")
+
+    if (len(args.inputdir) < 1):
+        print("No benchmark specified")
+        sys.exit(1)
+
+    task = args.inputdir[0]
+    task_list = args.inputdir[1:]
+
+    if (task == "compress"):
+        benchmark_compressors(task_list, args.compressors.split(","))
+
+    elif (task == "checksum"):
+        benchmark_checksums(task_list, args.algorithms.split(","),
+                            [int(b)*1024 for b in args.blocksizes.split(",")],
+                            args.fpack_threads, config.tar_scratchdir)
+
+    else:
+        print("Unknown benchmark: %s" % (task))
+        sys.exit(1)
@@ -0,0 +1,123 @@
+import threading
+import time
+import logging
+
+
+class Bundle(object):
+
+    def __init__(self):
+        self.members = []
+        self.n_bytes = 0
+        self.closed = False
+        self.done = threading.Event()
+        self.success = False
+        self.transfer_time = -1
+
+
+class TransferBundler(object):
+    """Sends the tar-balls of several small exposures with a single rsync/scp
+    call, so they share one connection to the archive instead of paying for
+    a ssh handshake each.
+
+    The first exposure to arrive opens a bundle and waits up to max_wait
+    seconds for others to join, then sends all of them at once; the bundle is
+    sent right away once it holds max_count exposures or max_bytes."""
+
+    def __init__(self, max_bytes, max_count=10, max_wait=5.):
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.max_wait = max_wait
+        self.logger = logging.getLogger("Bundler")
+
+        self.lock = threading.Condition()
+        # the bundle currently open for new exposures, for each destination
+        self.open_bundles = {}
+
+    def accepts(self, exposure):
+        return (exposure.transfer_protocol in ['rsync', 'scp'] and
+                exposure.tar_filesize < self.max_bytes)
+
+    def transfer(self, exposure):
+        # returns True/False if the exposure was sent as part of a bundle, or
+        # None if the bundle failed and the exposure needs to be sent alone
+
+        destination = (exposure.transfer_protocol, exposure.remote_target_directory,
+                       exposure.bandwidth_limit)
+        with self.lock:
+            bundle = self.open_bundles.get(destination)
+            if (bundle is None or bundle.n_bytes + exposure.tar_filesize > self.max_bytes):
+                if (bundle is not None):
+                    # make room for a new bundle, the leader of this one
+                    # sends it as soon as it notices
+                    bundle.closed = True
+                    self.lock.notify_all()
+                bundle = Bundle()
+                self.open_bundles[destination] = bundle
+            bundle.members.append(exposure)
+            bundle.n_bytes += exposure.tar_filesize
+            if (len(bundle.members) >= self.max_count):
+                bundle.closed = True
+                self.lock.notify_all()
+            is_leader = (bundle.members[0] is exposure)
+
+            if (is_leader):
+                # wait for others to join
+                end_time = time.time() + self.max_wait
+                while (not bundle.closed and time.time() < end_time):
+                    self.lock.wait(timeout=end_time - time.time())
+                bundle.closed = True
+                if (self.open_bundles.get(destination) is bundle):
+                    del self.open_bundles[destination]
+
+        if (not is_leader):
+            exposure.logger.info("Waiting for %s to send the tar-ball as part of a bundle" % (
+                bundle.members[0].obsid))
+            bundle.done.wait()
+        else:
+            try:
+                self.send_bundle(bundle)
+            except Exception:
+                bundle.success = False
+                raise
+            finally:
+                # never leave the others waiting
+                bundle.done.set()
+
+        if (not bundle.success):
+            return None if len(bundle.members) > 1 else False
+        # split the time in proportion to the size, so the bandwidth reported
+        # for each exposure is that of the whole bundle
+        exposure.tar_transfer_time = bundle.transfer_time * exposure.tar_filesize / max(1, bundle.n_bytes)
+        return True
+
+    def send_bundle(self, bundle):
+        leader = bundle.members[0]
+        cmd = leader.transfer_command([e.tar_filename for e in bundle.members])
+        timeout = leader.transfer_timeout * len(bundle.members) \
+            if leader.transfer_timeout is not None else None
+
+        self.logger.info("Sending %d exposures (%s, %.1f MB) in one %s call" % (
+            len(bundle.members), ", ".join([e.obsid for e in bundle.members]),
+            bundle.n_bytes / 2**20, leader.transfer_protocol))
+        start_time = time.time()
+        returncode = leader.execute(cmd, timeout=timeout)
+        bundle.transfer_time = time.time() - start_time
+        bundle.success = (returncode == 0)
+        if (bundle.success):
+            self.logger.info("Done with bundle transfer, time=%.1f seconds, bandwidth: %d bytes/sec" % (
+                bundle.transfer_time, bundle.n_bytes // max(bundle.transfer_time, 1e-3)))
+        elif (len(bundle.members) > 1):
+            self.logger.warning("Bundle transfer failed (%d), sending each exposure on its own" % (returncode))
+
+
+bundlers = {}
+bundlers_lock = threading.Lock()
+
+
+def open_bundler(max_bytes, max_count, max_wait):
+    # all exposures transferred by this process share the same bundler
+    key = (max_bytes, max_count, max_wait)
+    with bundlers_lock:
+        if (key not in bundlers):
+            bundlers[key] = TransferBundler(max_bytes, max_count, max_wait)
+        return bundlers[key]
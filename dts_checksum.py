@@ -0,0 +1,88 @@
+import os
+import mmap
+import hashlib
+
+
+# large reads keep the per-call overhead of Python out of the way; hashlib
+# releases the GIL while hashing blocks of this size
+DEFAULT_BLOCKSIZE = 4*2**20
+
+
+class HashingWriter(object):
+    """File-like wrapper that checksums all data while it is being written,
+    so files never have to be read back just to compute their MD5. Extra
+    algorithms (e.g. blake2b) are computed in the same pass"""
+
+    def __init__(self, fileobj, algorithm='md5', extra_algorithms=()):
+        self.fileobj = fileobj
+        self.hasher = hashlib.new(algorithm)
+        self.extra_hashers = dict([(name, hashlib.new(name)) for name in extra_algorithms])
+        self.bytes_written = 0
+
+    def write(self, data):
+        # len() counts items, not bytes, for e.g. numpy arrays or memoryviews
+        n = memoryview(data).nbytes
+        self.fileobj.write(data)
+        self.hasher.update(data)
+        for hasher in self.extra_hashers.values():
+            hasher.update(data)
+        self.bytes_written += n
+        return n
+
+    def tell(self):
+        # only count what went through us - this also works on pipes
+        return self.bytes_written
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def extra_hexdigests(self):
+        return dict([(name, hasher.hexdigest()) for (name, hasher) in self.extra_hashers.items()])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def file_checksums(fn, algorithms=('md5',), blocksize=DEFAULT_BLOCKSIZE, use_mmap=False):
+    # all requested checksums of a file, computed in a single pass
+    with open(fn, 'rb') as afile:
+        return fileobj_checksums(afile, algorithms, blocksize, use_mmap)
+
+
+def fileobj_checksums(afile, algorithms=('md5',), blocksize=DEFAULT_BLOCKSIZE, use_mmap=False):
+    # same for a file that is already open, read from the start
+    hashers = [hashlib.new(name) for name in algorithms]
+    afile.seek(0)
+    if (use_mmap):
+        size = os.fstat(afile.fileno()).st_size
+        if (size > 0):
+            with mmap.mmap(afile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                for start in range(0, size, blocksize):
+                    for hasher in hashers:
+                        hasher.update(view[start:start+blocksize])
+                view.release()
+    else:
+        # re-use the same buffer for all reads
+        buffer = bytearray(blocksize)
+        view = memoryview(buffer)
+        while (True):
+            n = afile.readinto(buffer)
+            if (n <= 0):
+                break
+            for hasher in hashers:
+                hasher.update(view[:n])
+    return [hasher.hexdigest() for hasher in hashers]
+
+
+def file_checksum(fn, algorithm='md5', blocksize=DEFAULT_BLOCKSIZE, use_mmap=False):
+    return file_checksums(fn, (algorithm,), blocksize=blocksize, use_mmap=use_mmap)[0]
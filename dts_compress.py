@@ -0,0 +1,86 @@
+import logging
+
+try:
+    import astropy.io.fits as pyfits
+except ImportError:
+    pyfits = None
+
+
+class FpackCompressor(object):
+    """Compress files by running the external fpack binary"""
+
+    name = 'fpack'
+
+    def __init__(self, execute, logger=None):
+        self.execute = execute
+        self.logger = logger if logger is not None else logging.getLogger("Compressor")
+
+    def settings(self):
+        return "fpack -S"
+
+    def compress(self, in_file, writer):
+        cmd = "fpack -S %s" % (in_file)
+        return self.execute(cmd, redirect_stdout=writer)
+
+
+class AstropyCompressor(object):
+    """Rice tile compression done in-process with astropy, writing the same
+    layout as fpack: an empty primary HDU followed by one compressed image
+    extension per image HDU; all other extensions are copied unchanged"""
+
+    name = 'astropy'
+
+    # same defaults as fpack: Rice, row-by-row tiles, q=4 and subtractive
+    # dithering for floating point data (astropy does not dither by default)
+    compression_type = 'RICE_1'
+    quantize_level = 4.0
+    quantize_method = 1     # SUBTRACTIVE_DITHER_1
+
+    def __init__(self, execute=None, logger=None):
+        if (pyfits is None):
+            raise ValueError("astropy is required for the astropy compressor")
+        self.logger = logger if logger is not None else logging.getLogger("Compressor")
+
+    def settings(self):
+        return "astropy %s q=%.1f" % (self.compression_type, self.quantize_level)
+
+    def compress(self, in_file, writer):
+        try:
+            with pyfits.open(in_file, memmap=True) as hdulist:
+                primary = hdulist[0]
+                out_hdus = [pyfits.PrimaryHDU(header=primary.header if primary.data is None else None)]
+                for hdu in hdulist:
+                    if (hdu is primary and hdu.data is None):
+                        continue
+                    if (isinstance(hdu, (pyfits.PrimaryHDU, pyfits.ImageHDU)) and hdu.data is not None):
+                        # converting to an ImageHDU turns a primary header into an extension header
+                        ext = pyfits.ImageHDU(data=hdu.data, header=hdu.header)
+                        out_hdus.append(pyfits.CompImageHDU(
+                            data=ext.data, header=ext.header,
+                            compression_type=self.compression_type,
+                            quantize_level=self.quantize_level,
+                            quantize_method=self.quantize_method))
+                    else:
+                        out_hdus.append(hdu.copy())
+
+                # the writer counts its own position, so astropy can write
+                # to it without seeking, even if it is a pipe
+                pyfits.HDUList(out_hdus).writeto(writer)
+        except Exception as e:
+            # e.g. a VerifyError from a broken header; like a failing fpack,
+            # this only fails the file
+            self.logger.error("Unable to compress %s: %s" % (in_file, str(e)))
+            return 1
+        return 0
+
+
+compressors = {
+    'fpack': FpackCompressor,
+    'astropy': AstropyCompressor,
+}
+
+
+def get_compressor(name, execute, logger=None):
+    if (name not in compressors):
+        raise ValueError("Unknown compressor: %s" % (name))
+    return compressors[name](execute=execute, logger=logger)
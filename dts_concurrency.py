@@ -0,0 +1,159 @@
+import threading
+import time
+import logging
+
+
+class ConcurrencyLimiter(object):
+    """Limits how many of the worker threads may work on an exposure at the
+    same time; the limit can be changed while the workers are running"""
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.active = 0
+        self.cv = threading.Condition()
+
+    def acquire(self):
+        with self.cv:
+            self.cv.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    def release(self):
+        with self.cv:
+            self.active -= 1
+            self.cv.notify_all()
+
+    def set_limit(self, limit):
+        # workers above the new limit finish their current exposure, but do
+        # not start a new one
+        with self.cv:
+            self.limit = max(1, limit)
+            self.cv.notify_all()
+
+
+def read_cpu_times():
+    # cumulative (busy, iowait, total) CPU time of all cores, from /proc/stat
+    try:
+        with open("/proc/stat", "r") as f:
+            fields = [int(x) for x in f.readline().split()[1:]]
+    except (IOError, OSError, ValueError):
+        return None
+    # user nice system idle iowait irq softirq steal ...
+    idle, iowait = fields[3], fields[4]
+    total = sum(fields[:8])
+    return (total - idle - iowait, iowait, total)
+
+
+class AdaptiveController(threading.Thread):
+    """Raises or lowers the number of active transfer workers, within
+    min_threads and max_threads, based on the throughput of completed
+    exposures and on how busy the CPU and disks are.
+
+    Every interval it adds a worker as long as there is work waiting and the
+    machine is not saturated, keeps the new worker only if it made the
+    throughput go up, and drops workers once CPU or I/O wait saturate."""
+
+    def __init__(self, limiter, min_threads, max_threads, work_waiting,
+                 interval=60, cpu_limit=0.9, iowait_limit=0.25, min_gain=0.05):
+        threading.Thread.__init__(self, name="AdaptiveController")
+        self.limiter = limiter
+        self.min_threads = max(1, min_threads)
+        self.max_threads = max(self.min_threads, max_threads)
+        self.work_waiting = work_waiting
+        self.interval = interval
+        self.cpu_limit = cpu_limit
+        self.iowait_limit = iowait_limit
+        self.min_gain = min_gain
+        self.logger = logging.getLogger("Adaptive")
+
+        self.limiter.set_limit(min(max(self.limiter.limit, self.min_threads), self.max_threads))
+
+        # statistics of exposures completed since the last decision
+        self.lock = threading.Lock()
+        self.bytes_done = 0
+        self.exposures_done = 0
+        self.stage_times = {}
+
+        self.last_throughput = None
+        self.last_change = 0
+        self.hold = 0
+        self.shutdown = False
+        self.daemon = True
+
+    def record_exposure(self, exposure):
+        # called by the workers with each DTS they completed
+        if (exposure is None):
+            return
+        with self.lock:
+            self.exposures_done += 1
+            self.bytes_done += exposure.bytes_in
+            for stage, stage_time in exposure.stage_times.items():
+                self.stage_times[stage] = self.stage_times.get(stage, 0.) + stage_time
+
+    def run(self):
+        last_cpu = read_cpu_times()
+        last_time = time.time()
+        while (not self.shutdown):
+            time.sleep(self.interval)
+            now = time.time()
+            cpu = read_cpu_times()
+            with self.lock:
+                bytes_done, self.bytes_done = self.bytes_done, 0
+                exposures_done, self.exposures_done = self.exposures_done, 0
+                stage_times, self.stage_times = self.stage_times, {}
+
+            cpu_busy = iowait = None
+            if (cpu is not None and last_cpu is not None and cpu[2] > last_cpu[2]):
+                cpu_busy = float(cpu[0] - last_cpu[0]) / (cpu[2] - last_cpu[2])
+                iowait = float(cpu[1] - last_cpu[1]) / (cpu[2] - last_cpu[2])
+            throughput = bytes_done / (now - last_time)
+            last_cpu, last_time = cpu, now
+
+            self.decide(throughput, exposures_done, cpu_busy, iowait, stage_times)
+
+    def decide(self, throughput, exposures_done, cpu_busy, iowait, stage_times):
+
+        limit = self.limiter.limit
+        saturated = (cpu_busy is not None and
+                     (cpu_busy >= self.cpu_limit or iowait >= self.iowait_limit))
+
+        if (saturated and limit > self.min_threads):
+            new_limit, reason = limit - 1, "CPU or disk saturated"
+            self.hold = 5
+        elif (exposures_done == 0):
+            new_limit, reason = limit, "no exposures completed"
+        elif (self.last_change > 0 and self.last_throughput is not None and
+              throughput < self.last_throughput * (1. + self.min_gain)):
+            # the extra worker did not help, so back off and stay there for a while
+            new_limit, reason = limit - 1, "last increase did not improve throughput"
+            self.hold = 5
+        elif (self.hold > 0):
+            self.hold -= 1
+            new_limit, reason = limit, "holding after backing off"
+        elif (not self.work_waiting()):
+            new_limit, reason = limit, "no exposures waiting"
+        elif (saturated):
+            new_limit, reason = limit, "CPU or disk saturated"
+        elif (limit < self.max_threads):
+            new_limit, reason = limit + 1, "exposures waiting and capacity left"
+        else:
+            new_limit, reason = limit, "at maximum"
+        new_limit = min(max(new_limit, self.min_threads), self.max_threads)
+
+        total_stage_time = sum(stage_times.values())
+        stage_share = ", ".join(["%s %d%%" % (stage, 100. * t / total_stage_time)
+                                 for (stage, t) in sorted(stage_times.items())]) \
+            if total_stage_time > 0 else "n/a"
+        self.logger.info("%s workers %d -> %d (%s): %.1f MB/s from %d exposures, "
+                         "CPU %s, iowait %s, time per stage: %s" % (
+            "Raising" if new_limit > limit else "Lowering" if new_limit < limit else "Keeping",
+            limit, new_limit, reason, throughput / 2**20, exposures_done,
+            "%d%%" % (100 * cpu_busy) if cpu_busy is not None else "n/a",
+            "%d%%" % (100 * iowait) if iowait is not None else "n/a",
+            stage_share))
+
+        if (exposures_done > 0 or new_limit != limit):
+            # a change is only judged once exposures finished with it
+            self.last_change = new_limit - limit
+        if (exposures_done > 0):
+            self.last_throughput = throughput
+        self.limiter.set_limit(new_limit)
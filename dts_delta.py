@@ -0,0 +1,70 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import logging
+
+
+class ShipmentLog(object):
+    """Remembers, for each OBSID, the checksum of every member of the last
+    complete tar-ball sent to the archive, together with the size and
+    modification time of the file it was made from. A resend can then leave
+    out all files that did not change since, and only send a delta package.
+    Deltas are always made against the last complete tar-ball, the record
+    only counts how many were sent since."""
+
+    def __init__(self, directory, logger=None):
+        self.directory = directory
+        self.logger = logger if logger is not None else logging.getLogger("ShipmentLog")
+        if (not os.path.isdir(self.directory)):
+            os.makedirs(self.directory)
+
+    def filename(self, obsid):
+        return os.path.join(self.directory, "%s.json" % (str(obsid).replace(os.sep, "_")))
+
+    def load(self, obsid):
+        try:
+            with open(self.filename(obsid), "r") as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return None
+        except ValueError:
+            self.logger.warning("Ignoring corrupt shipment record %s" % (self.filename(obsid)))
+            return None
+
+    def save(self, obsid, tar_checksum, members, deltas=0):
+        # members: dictionary of member name -> dict(md5, size, mtime_ns)
+        record = dict(obsid=obsid, tar_checksum=tar_checksum, time=time.time(), members=members,
+                      deltas=deltas)
+        try:
+            fd, tmp_filename = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(record, f, indent=1)
+            os.rename(tmp_filename, self.filename(obsid))
+        except (IOError, OSError) as e:
+            self.logger.warning("Unable to save shipment record for %s: %s" % (obsid, str(e)))
+
+
+def unchanged_members(manifest, previous):
+    # members of the last shipment whose source files are still the same,
+    # as member name -> md5
+    unchanged = {}
+    members = previous.get('members', {}) if previous is not None else {}
+    for entry in manifest.entries:
+        shipped = members.get(entry.out_file)
+        if (shipped is not None and shipped['size'] == entry.size and shipped['mtime_ns'] == entry.mtime_ns):
+            unchanged[entry.out_file] = shipped['md5']
+    return unchanged
+
+
+logs = {}
+logs_lock = threading.Lock()
+
+
+def open_log(directory):
+    # all exposures handled by this process share the same log
+    with logs_lock:
+        if (directory not in logs):
+            logs[directory] = ShipmentLog(directory)
+        return logs[directory]
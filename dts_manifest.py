@@ -0,0 +1,76 @@
+import os
+import stat
+import collections
+import logging
+
+
+ManifestEntry = collections.namedtuple(
+    "ManifestEntry", ["in_file", "out_file", "compress", "include_md5", "size", "mtime_ns"])
+
+
+class ExposureManifest(object):
+    """All files of one exposure with their size and modification time, as
+    found by a single scan of the exposure directory. All later stages work
+    from this instead of going back to the (NFS-mounted) disk"""
+
+    def __init__(self, directory, entries):
+        self.directory = directory
+        self.entries = entries
+        self.by_filename = dict([(entry.in_file, entry) for entry in entries])
+        self.total_bytes = sum([entry.size for entry in entries])
+
+    def filelist(self):
+        # in the [in_file, out_file, compress, include_md5] format used by the DTS
+        return [[entry.in_file, entry.out_file, entry.compress, entry.include_md5] for entry in self.entries]
+
+    def get(self, in_file):
+        return self.by_filename.get(in_file)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def scan_fits(directory, out_directory, logger):
+    # all non-empty FITS files in a directory, unsorted like glob
+    entries = []
+    try:
+        with os.scandir(directory) as dir_entries:
+            for dir_entry in dir_entries:
+                if (not dir_entry.name.endswith(".fits") or dir_entry.name.startswith(".")):
+                    continue
+                try:
+                    st = dir_entry.stat()
+                except OSError:
+                    continue
+                if (st.st_size <= 0):
+                    logger.warning("Detected (and skipped) empty file: %s" % (dir_entry.path))
+                    continue
+                entries.append(ManifestEntry(
+                    dir_entry.path, os.path.join(out_directory, dir_entry.name)+".fz", True, True,
+                    st.st_size, st.st_mtime_ns))
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return entries
+
+
+def scan_exposure(directory, logger=None):
+    """Collect the FITS files, expVideo files and metainf.xml of an exposure
+    with one directory scan each"""
+
+    if (logger is None):
+        logger = logging.getLogger("Manifest")
+    directory = os.path.abspath(directory)
+
+    entries = scan_fits(directory, "", logger)
+    # expVideo files go in a sub-directory
+    entries += scan_fits(os.path.join(directory, "expVideo"), "expVideo", logger)
+
+    metainf = os.path.join(directory, "metainf.xml")
+    try:
+        st = os.stat(metainf)
+        if (stat.S_ISREG(st.st_mode)):
+            entries.append(ManifestEntry(metainf, "metainf.xml", False, False, st.st_size, st.st_mtime_ns))
+    except OSError:
+        pass
+
+    return ExposureManifest(directory, entries)
@@ -0,0 +1,166 @@
+import threading
+import queue
+import time
+import logging
+import traceback
+
+
+class PipelineStage(object):
+    """A pool of worker threads that take exposures from the input queue, run
+    one step of the transfer on them, and hand them on to the next stage"""
+
+    def __init__(self, name, function, n_workers, in_queue, out_queue=None,
+                 on_error=None, on_finished=None):
+        self.name = name
+        self.function = function
+        self.n_workers = max(1, n_workers)
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.on_error = on_error
+        self.on_finished = on_finished
+        self.logger = logging.getLogger("Pipeline")
+
+        # bookkeeping for the utilization statistics
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.busy_time = 0.
+        self.busy_since = {}
+        self.processed = 0
+
+        self.threads = []
+
+    def start(self):
+        for i in range(self.n_workers):
+            t = threading.Thread(target=self.run, name="%s-%d" % (self.name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def run(self):
+        while (True):
+            item = self.in_queue.get()
+            if (item is None):
+                self.in_queue.task_done()
+                break
+
+            start_time = time.time()
+            with self.lock:
+                self.busy += 1
+                self.busy_since[threading.current_thread().name] = start_time
+            try:
+                result = self.function(item)
+            except Exception as e:
+                self.logger.error("Stage %s failed: %s\n%s" % (self.name, str(e), traceback.format_exc()))
+                result = self.on_error(item, self.name, e) if self.on_error is not None else None
+            with self.lock:
+                self.busy -= 1
+                del self.busy_since[threading.current_thread().name]
+                self.busy_time += time.time() - start_time
+                self.processed += 1
+
+            if (result is not None and self.out_queue is not None):
+                # this blocks while the next stage is still busy
+                self.out_queue.put(result)
+            elif (self.on_finished is not None):
+                # this item has reached the end of the pipeline
+                self.on_finished(item)
+            self.in_queue.task_done()
+
+    def stop(self):
+        for t in self.threads:
+            self.in_queue.put(None)
+
+    def get_busy_time(self):
+        # include the time spent so far on items that are still being worked on
+        now = time.time()
+        with self.lock:
+            return self.busy_time + sum([now - t for t in self.busy_since.values()])
+
+
+class DTS_Pipeline(object):
+    """Runs the transfer of many exposures as a pipeline of stages, each with
+    its own pool of workers and bounded queues in between, so one exposure
+    can be compressed while the one before it is still being transferred.
+
+    Each stage is a (name, function, number of workers) tuple. The function
+    of the first stage receives what was handed to put(), all others receive
+    what the stage before returned; returning None drops the item."""
+
+    def __init__(self, stages, queue_depth=2, on_done=None, on_error=None, report_every=60):
+        self.logger = logging.getLogger("Pipeline")
+        self.on_done = on_done
+        self.report_every = report_every
+
+        self.pending = 0
+        self.pending_cv = threading.Condition()
+
+        self.queues = [queue.Queue(maxsize=queue_depth) for s in stages]
+        self.stages = []
+        for idx, (name, function, n_workers) in enumerate(stages):
+            out_queue = self.queues[idx+1] if idx+1 < len(stages) else None
+            self.stages.append(PipelineStage(
+                name=name, function=function, n_workers=n_workers,
+                in_queue=self.queues[idx], out_queue=out_queue,
+                on_error=on_error, on_finished=self.item_done,
+            ))
+
+        self.shutdown = False
+        self.monitor = threading.Thread(target=self.run_monitor, name="PipelineMonitor")
+        self.monitor.daemon = True
+
+    def item_done(self, item):
+        if (self.on_done is not None):
+            self.on_done(item)
+        with self.pending_cv:
+            self.pending -= 1
+            self.pending_cv.notify_all()
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        self.monitor.start()
+
+    def put(self, item):
+        # blocks while the first stage is busy
+        with self.pending_cv:
+            self.pending += 1
+        self.queues[0].put(item)
+
+    def put_later(self, item, delay):
+        # hand item to the first stage again after delay seconds; join()
+        # keeps waiting for it in the meantime
+        with self.pending_cv:
+            self.pending += 1
+        timer = threading.Timer(delay, self.queues[0].put, (item,))
+        timer.daemon = True
+        timer.start()
+
+    def join(self, timeout=None):
+        # wait until all exposures have passed through all stages
+        with self.pending_cv:
+            return self.pending_cv.wait_for(lambda: self.pending <= 0, timeout=timeout)
+
+    def stop(self):
+        self.shutdown = True
+        for stage in self.stages:
+            stage.stop()
+
+    def run_monitor(self):
+        last_time = time.time()
+        last_busy = [stage.get_busy_time() for stage in self.stages]
+        while (not self.shutdown):
+            time.sleep(self.report_every)
+            now = time.time()
+            busy = [stage.get_busy_time() for stage in self.stages]
+            self.report_status(now - last_time, [b - lb for (b, lb) in zip(busy, last_busy)])
+            last_time, last_busy = now, busy
+
+    def report_status(self, interval, busy_times):
+        status = []
+        for stage, busy_time in zip(self.stages, busy_times):
+            status.append("%s[queue %d/%d, busy %d/%d, util %3d%%, done %d]" % (
+                stage.name, stage.in_queue.qsize(), stage.in_queue.maxsize,
+                stage.busy, stage.n_workers,
+                100. * busy_time / (stage.n_workers * interval),
+                stage.processed))
+        self.logger.info("%d exposures in pipeline: %s" % (self.pending, " ".join(status)))
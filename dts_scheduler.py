@@ -0,0 +1,287 @@
+import os
+import glob
+import time
+import calendar
+import datetime
+import heapq
+import itertools
+import threading
+import collections
+import logging
+
+import fits_header
+import dts_manifest
+
+
+# in order of precedence, with the default share of transfer slots
+QOS_CLASSES = ['science', 'calibration', 'resend', 'backfill']
+DEFAULT_WEIGHTS = dict(science=8, calibration=4, resend=2, backfill=1)
+
+CALIBRATION_TYPES = ['BIAS', 'DARK', 'DFLAT', 'TFLAT', 'SFLAT', 'FLAT', 'FOCUS', 'ZERO']
+
+
+def parse_class_values(option, default=None):
+    # turns "resend=2,backfill=1" into a dictionary
+    values = dict(default) if default is not None else {}
+    for class_value in option.split(","):
+        if (class_value.strip() == ''):
+            continue
+        name, value = class_value.split("=")
+        if (name not in QOS_CLASSES):
+            raise ValueError("Unknown QoS class: %s" % (name))
+        values[name] = float(value)
+    return values
+
+
+def exposure_time(dir, obsid):
+    # OBSIDs start with the UT of the exposure, e.g. 20141103T123456.1
+    try:
+        return calendar.timegm(datetime.datetime.strptime(obsid[:15], "%Y%m%dT%H%M%S").timetuple())
+    except (TypeError, ValueError):
+        pass
+    try:
+        return os.path.getmtime(dir)
+    except (TypeError, OSError):
+        return time.time()
+
+
+def observation_type(dir, header_index=None):
+    # OBSTYPE from the header of the first FITS file of the exposure
+    try:
+        fits_files = sorted(glob.glob(os.path.join(dir, "*.fits")))
+        if (len(fits_files) > 0):
+            obstype = fits_header.find_keyword(fits_files[:1], 'OBSTYPE', index=header_index)
+            return str(obstype if obstype is not None else '').strip().upper()
+    except (TypeError, IOError, OSError):
+        pass
+    return ''
+
+
+def estimate_exposure_bytes(dir):
+    # size of all files of an exposure, from a quick directory scan
+    if (dir is None):
+        return 0
+    return dts_manifest.scan_exposure(dir, logger=logging.getLogger("Queue")).total_bytes
+
+
+def shortest_job_first(aging_rate):
+    # Sort key for exposures: smallest first, but every second of age counts
+    # as aging_rate bytes less, so large exposures can not starve. As this
+    # uses the time the exposure was taken, the order never changes while
+    # exposures wait, and the score is only worked out once per exposure
+    scores = {}
+    scores_lock = threading.Lock()
+
+    def score(exposure_info):
+        (dir, obsid, extra) = exposure_info
+        with scores_lock:
+            if ((dir, obsid) in scores):
+                return scores[(dir, obsid)]
+        exposure_score = estimate_exposure_bytes(dir) + aging_rate * exposure_time(dir, obsid)
+        with scores_lock:
+            if (len(scores) >= 10000):
+                scores.clear()
+            scores[(dir, obsid)] = exposure_score
+        return exposure_score
+    return score
+
+
+class WaitStatistics(object):
+    """How long exposures sit in the work queue before a worker picks them up"""
+
+    def __init__(self, logger, report_every=25):
+        self.logger = logger
+        self.report_every = report_every
+        self.n = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+    def add(self, wait_time):
+        self.n += 1
+        self.total_wait += wait_time
+        self.max_wait = max(self.max_wait, wait_time)
+        if (self.n % self.report_every == 0):
+            self.logger.info("Queue wait time: mean %.1f s, max %.1f s over %d exposures" % (
+                self.total_wait / self.n, self.max_wait, self.n))
+
+
+class PriorityExposureQueue(object):
+    """Drop-in replacement for the work queue of the transfer workers that
+    hands out exposures by the given score, lowest first (by default
+    shortest-job-first with aging), instead of in the order they were queued"""
+
+    def __init__(self, score):
+        self.score = score
+        self.logger = logging.getLogger("Queue")
+        self.cv = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count()
+        self.stop_requests = 0
+        self.wait_stats = WaitStatistics(self.logger)
+
+    def put(self, exposure_info):
+        if (exposure_info is not None):
+            score = self.score(exposure_info)
+        with self.cv:
+            if (exposure_info is None):
+                # workers only stop once all exposures are done
+                self.stop_requests += 1
+            else:
+                heapq.heappush(self.heap, (score, next(self.counter), time.time(), exposure_info))
+            self.cv.notify()
+
+    def get(self):
+        with self.cv:
+            while (len(self.heap) == 0):
+                if (self.stop_requests > 0):
+                    self.stop_requests -= 1
+                    return None
+                self.cv.wait()
+            (_, _, queue_time, exposure_info) = heapq.heappop(self.heap)
+            wait_time = time.time() - queue_time
+            self.wait_stats.add(wait_time)
+            self.logger.info("Starting exposure %s after %.1f s in the queue (%d waiting)" % (
+                exposure_info[1], wait_time, len(self.heap)))
+            return exposure_info
+
+    def task_done(self):
+        pass
+
+    def qsize(self):
+        with self.cv:
+            return len(self.heap)
+
+    def dts_options(self, exposure_info):
+        return {}
+
+    def priority(self, exposure_info):
+        # for sorting exposures before queueing them
+        return self.score(exposure_info)
+
+
+def classify_exposure(exposure_info, backfill_age=86400, header_index=None):
+    (dir, obsid, extra) = exposure_info
+    if (extra == "resend"):
+        return 'resend'
+    if (time.time() - exposure_time(dir, obsid) > backfill_age):
+        return 'backfill'
+    if (observation_type(dir, header_index) in CALIBRATION_TYPES):
+        return 'calibration'
+    return 'science'
+
+
+class QoSScheduler(object):
+    """Drop-in replacement for the work queue of the transfer workers that
+    keeps one queue per class of exposures (fresh science data, calibrations,
+    PPA resends, backfill of old data) and shares the workers between all
+    classes with waiting exposures in proportion to their weights (stride
+    scheduling), so a large resend can no longer hold up tonight's data.
+
+    Each class can also have its own bandwidth limit for rsync/scp. Within
+    a class, exposures go out in the order of the optional score function
+    (lowest first), or in the order they were queued."""
+
+    MAX_CACHED = 10000
+
+    def __init__(self, weights=None, bandwidth_limits=None, backfill_age=86400, score=None,
+                 header_index=None):
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if (weights is not None):
+            self.weights.update(weights)
+        self.bandwidth_limits = bandwidth_limits if bandwidth_limits is not None else {}
+        self.backfill_age = backfill_age
+        self.header_index = header_index
+        self.score = score if score is not None else (lambda exposure_info: 0)
+        self.logger = logging.getLogger("QoS")
+
+        self.cv = threading.Condition()
+        self.queues = dict([(name, []) for name in QOS_CLASSES])
+        self.counter = itertools.count()
+        self.wait_stats = WaitStatistics(self.logger)
+        # virtual time of each class; the class furthest behind goes next
+        self.passes = dict([(name, 0.) for name in QOS_CLASSES])
+        self.classes = {}
+        # classes already worked out, by OBSID and resend flag
+        self.class_cache = {}
+        self.stop_requests = 0
+        self.dispatched = collections.Counter()
+
+    def classify(self, exposure_info):
+        # this looks at the files, and is asked for every time the database
+        # is checked while an exposure waits, so remember it until the
+        # exposure is handed to a worker
+        key = (exposure_info[1], exposure_info[2])
+        with self.cv:
+            qos_class = self.class_cache.get(key)
+        if (qos_class is None):
+            qos_class = classify_exposure(exposure_info, backfill_age=self.backfill_age,
+                                          header_index=self.header_index)
+            with self.cv:
+                if (len(self.class_cache) >= self.MAX_CACHED):
+                    # exposures that never made it into the queue
+                    self.class_cache.clear()
+                self.class_cache[key] = qos_class
+        return qos_class
+
+    def put(self, exposure_info):
+        if (exposure_info is not None):
+            # this looks at the files, so do it before taking the lock
+            qos_class = self.classify(exposure_info)
+            score = self.score(exposure_info)
+        with self.cv:
+            if (exposure_info is None):
+                # workers only stop once all exposures are done
+                self.stop_requests += 1
+            else:
+                self.classes[exposure_info[1]] = qos_class
+                if (len(self.queues[qos_class]) == 0):
+                    # a class that was idle does not get to catch up on the
+                    # slots it did not need
+                    busy = [self.passes[name] for name in QOS_CLASSES if len(self.queues[name]) > 0]
+                    if (len(busy) > 0):
+                        self.passes[qos_class] = max(self.passes[qos_class], min(busy))
+                heapq.heappush(self.queues[qos_class], (score, next(self.counter),
+                                                        time.time(), exposure_info))
+            self.cv.notify()
+
+    def get(self):
+        with self.cv:
+            while (True):
+                waiting = [name for name in QOS_CLASSES if len(self.queues[name]) > 0]
+                if (len(waiting) > 0):
+                    break
+                if (self.stop_requests > 0):
+                    self.stop_requests -= 1
+                    return None
+                self.cv.wait()
+
+            # ties go to the class with higher precedence
+            qos_class = min(waiting, key=lambda name: self.passes[name])
+            self.passes[qos_class] += 1. / max(self.weights[qos_class], 1e-3)
+            self.dispatched[qos_class] += 1
+            (_, _, queue_time, exposure_info) = heapq.heappop(self.queues[qos_class])
+            self.class_cache.pop((exposure_info[1], exposure_info[2]), None)
+            wait_time = time.time() - queue_time
+            self.wait_stats.add(wait_time)
+            self.logger.info("Starting %s exposure %s after %.1f s in the queue (waiting: %s)" % (
+                qos_class, exposure_info[1], wait_time,
+                ", ".join(["%s=%d" % (name, len(self.queues[name])) for name in QOS_CLASSES])))
+            return exposure_info
+
+    def task_done(self):
+        pass
+
+    def qsize(self):
+        with self.cv:
+            return sum([len(q) for q in self.queues.values()])
+
+    def dts_options(self, exposure_info):
+        # extra options for the DTS of this exposure
+        qos_class = self.classes.pop(exposure_info[1], None)
+        if (qos_class in self.bandwidth_limits):
+            return dict(bandwidth_limit=self.bandwidth_limits[qos_class])
+        return {}
+
+    def priority(self, exposure_info):
+        # for sorting exposures before queueing them
+        return (QOS_CLASSES.index(self.classify(exposure_info)), self.score(exposure_info))
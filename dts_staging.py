@@ -0,0 +1,149 @@
+import os
+import errno
+import fcntl
+import shutil
+import threading
+import collections
+
+import dts_checksum
+
+
+# ioctl to share all data blocks of one file with another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# in order of preference; all but the last one leave the copying (or not
+# copying) to the kernel
+DEFAULT_METHODS = ['reflink', 'link', 'copy_file_range', 'sendfile', 'copy']
+
+# errors telling us a method is not available for this pair of file-systems,
+# rather than that something went wrong
+UNSUPPORTED_ERRORS = set([errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS,
+                          errno.EINVAL, errno.ENOTTY])
+
+# errors telling us a method does not work for this one file, e.g. hard
+# links to files of other users with fs.protected_hardlinks
+FILE_ERRORS = set([errno.EPERM, errno.EMLINK])
+
+CHUNK_SIZE = 64*2**20
+
+unsupported = set()
+method_counts = collections.Counter()
+stats_lock = threading.Lock()
+
+
+class StagedFile(object):
+    """Result of staging a file: how it was done and the checksums of its
+    content, with the same accessors as a HashingWriter"""
+
+    def __init__(self, method, bytes_written, digests, algorithm='md5'):
+        self.method = method
+        self.bytes_written = bytes_written
+        self.digests = digests
+        self.algorithm = algorithm
+
+    def hexdigest(self):
+        return self.digests[self.algorithm]
+
+    def extra_hexdigests(self):
+        return dict([(name, digest) for (name, digest) in self.digests.items() if name != self.algorithm])
+
+
+def hash_file(src, algorithm='md5', extra_algorithms=(), method='in place'):
+    # checksums straight from the page cache, without copying the data
+    # through Python buffers
+    algorithms = [algorithm] + [name for name in extra_algorithms if name != algorithm]
+    digests = dts_checksum.file_checksums(src, algorithms, use_mmap=True)
+    return StagedFile(method, os.path.getsize(src), dict(zip(algorithms, digests)), algorithm)
+
+
+def reflink(src_fd, dst_fd):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def copy_file_range(src_fd, dst_fd):
+    while (os.copy_file_range(src_fd, dst_fd, CHUNK_SIZE) > 0):
+        pass
+
+
+def sendfile(src_fd, dst_fd):
+    offset = 0
+    while (True):
+        n = os.sendfile(dst_fd, src_fd, offset, CHUNK_SIZE)
+        if (n <= 0):
+            break
+        offset += n
+
+
+KERNEL_COPIES = dict(reflink=reflink, copy_file_range=copy_file_range, sendfile=sendfile)
+
+
+def stage_file(src, dst, algorithm='md5', extra_algorithms=(), methods=None):
+    """Put a copy of src at dst using the cheapest method that works for
+    these two file-systems, and checksum the content. Returns a StagedFile.
+
+    A hard link shares the file with the source, so dst must never be
+    written to afterwards."""
+
+    if (methods is None):
+        methods = DEFAULT_METHODS
+    if (os.path.lexists(dst)):
+        # this might be a link to a source file, never write through it
+        os.remove(dst)
+
+    src_dev = os.stat(src).st_dev
+    dst_dev = os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+
+    for method in methods:
+        if ((method, src_dev, dst_dev) in unsupported):
+            continue
+        try:
+            staged = stage_with(method, src, dst, algorithm, extra_algorithms)
+        except OSError as e:
+            if ((e.errno not in UNSUPPORTED_ERRORS and e.errno not in FILE_ERRORS) or method == 'copy'):
+                raise
+            if (e.errno in UNSUPPORTED_ERRORS):
+                # remember, so we skip this method for all other files
+                with stats_lock:
+                    unsupported.add((method, src_dev, dst_dev))
+            if (os.path.lexists(dst)):
+                os.remove(dst)
+            continue
+        with stats_lock:
+            method_counts[method] += 1
+        return staged
+
+    raise IOError(errno.ENOTSUP, "No way to stage file", src)
+
+
+def stage_with(method, src, dst, algorithm, extra_algorithms):
+
+    if (method == 'link'):
+        os.link(src, dst)
+        return hash_file(src, algorithm, extra_algorithms, method)
+
+    if (method == 'copy'):
+        with open(src, "rb") as fsrc, \
+                dts_checksum.HashingWriter(open(dst, "wb"), algorithm, extra_algorithms) as fdst:
+            shutil.copyfileobj(fsrc, fdst, dts_checksum.DEFAULT_BLOCKSIZE)
+        shutil.copymode(src, dst)
+        digests = dict(fdst.extra_hexdigests())
+        digests[algorithm] = fdst.hexdigest()
+        return StagedFile(method, fdst.bytes_written, digests, algorithm)
+
+    if (method == 'copy_file_range' and not hasattr(os, 'copy_file_range')):
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        KERNEL_COPIES[method](fsrc.fileno(), fdst.fileno())
+    shutil.copymode(src, dst)
+    # the kernel did the copying, so read the checksums from the source,
+    # which is likely still in the page cache
+    return hash_file(src, algorithm, extra_algorithms, method)
+
+
+def report(logger):
+    with stats_lock:
+        if (len(method_counts) > 0):
+            logger.info("Staged files by %s" % (", ".join(
+                ["%s: %d" % (method, method_counts[method]) for method in DEFAULT_METHODS
+                 if method_counts[method] > 0])))
@@ -0,0 +1,157 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+import logging
+
+
+class TailBuffer(object):
+    """Keeps only the last max_size bytes written to it"""
+
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self.data = b''
+
+    def write(self, data):
+        self.data = (self.data + data)[-self.max_size:]
+        return len(data)
+
+    def getvalue(self):
+        return self.data
+
+
+class CommandResult(object):
+
+    def __init__(self, cmd, returncode, stdout, stderr, wall_time, cpu_time, timed_out):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.timed_out = timed_out
+
+
+class SupervisedProcess(object):
+    """Runs a single command. Its output is drained by background threads
+    while it runs, so it can never stall on a full pipe, and waiting for it
+    blocks in the kernel (wait4) instead of polling its status. Commands
+    running longer than the timeout get killed."""
+
+    def __init__(self, cmd, stdout=None, stdin=False, timeout=None,
+                 max_output=65536, logger=None):
+        self.cmd = cmd
+        self.args = cmd.split() if isinstance(cmd, str) else cmd
+        self.stdout_writer = stdout
+        self.use_stdin = stdin
+        self.timeout = timeout
+        self.max_output = max_output
+        self.logger = logger if logger is not None else logging.getLogger("Supervisor")
+
+        self.process = None
+        self.stdin = None
+        self.timed_out = False
+        self.write_error = None
+        self.result = None
+
+    def start(self):
+        self.start_time = time.time()
+        # each command gets its own process group, so a kill also takes care
+        # of anything it started itself (e.g. the ssh spawned by rsync)
+        self.process = subprocess.Popen(self.args,
+                                        stdin=subprocess.PIPE if self.use_stdin else None,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        start_new_session=True)
+        self.stdin = self.process.stdin
+
+        self.stdout_buffer = TailBuffer(self.max_output)
+        self.stderr_buffer = TailBuffer(self.max_output)
+        self.drain_threads = [
+            threading.Thread(target=self.drain,
+                             args=(self.process.stdout,
+                                   self.stdout_writer if self.stdout_writer is not None else self.stdout_buffer)),
+            threading.Thread(target=self.drain, args=(self.process.stderr, self.stderr_buffer)),
+        ]
+        for t in self.drain_threads:
+            t.daemon = True
+            t.start()
+
+        self.timer = None
+        if (self.timeout is not None):
+            self.timer = threading.Timer(self.timeout, self.on_timeout)
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def drain(self, pipe, writer):
+        with pipe:
+            for block in iter(lambda: pipe.read1(65536), b''):
+                if (self.write_error is not None):
+                    # keep reading so the command can finish, but drop the data
+                    continue
+                try:
+                    writer.write(block)
+                except (IOError, OSError) as e:
+                    self.write_error = e
+                    self.logger.error("Unable to write output of %s: %s" % (self.args[0], str(e)))
+
+    def on_timeout(self):
+        self.logger.error("Command timed out after %.1f seconds, killing it (%s)" % (
+            self.timeout, self.cmd))
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # already gone
+            pass
+
+    def wait(self):
+        if (self.result is not None):
+            return self.result
+
+        cpu_time = -1
+        try:
+            # this blocks until the command exits, and also tells us how much
+            # CPU time it used
+            _, status, rusage = os.wait4(self.process.pid, 0)
+            if (os.WIFSIGNALED(status)):
+                self.process.returncode = -os.WTERMSIG(status)
+            else:
+                self.process.returncode = os.WEXITSTATUS(status)
+            cpu_time = rusage.ru_utime + rusage.ru_stime
+        except ChildProcessError:
+            # somebody else reaped the process already
+            self.process.wait()
+        if (self.timer is not None):
+            self.timer.cancel()
+        if (self.stdin is not None and not self.stdin.closed):
+            # nobody is listening anymore, and any child the command left
+            # behind would otherwise keep its output pipes open
+            try:
+                self.stdin.close()
+            except (IOError, OSError):
+                pass
+        for t in self.drain_threads:
+            t.join()
+        wall_time = time.time() - self.start_time
+
+        returncode = self.process.returncode
+        if (returncode == 0 and self.write_error is not None):
+            returncode = -1
+
+        self.result = CommandResult(
+            cmd=self.cmd, returncode=returncode,
+            stdout=self.stdout_buffer.getvalue(), stderr=self.stderr_buffer.getvalue(),
+            wall_time=wall_time, cpu_time=cpu_time, timed_out=self.timed_out)
+        self.logger.debug("Command %s returned %d after %.2f seconds (%.2f seconds CPU)" % (
+            self.args[0], returncode, wall_time, cpu_time))
+        return self.result
+
+
+def run(cmd, stdout=None, timeout=None, logger=None):
+    return SupervisedProcess(cmd, stdout=stdout, timeout=timeout, logger=logger).start().wait()
@@ -0,0 +1,168 @@
+import os
+import time
+import shutil
+import threading
+import logging
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+
+class TransferResult(object):
+    """What a transfer did, the same for all transports"""
+
+    def __init__(self, success, n_bytes, duration, retries=0, method=None):
+        self.success = success
+        self.n_bytes = n_bytes
+        self.duration = duration
+        self.retries = retries
+        self.method = method
+
+    def bandwidth(self):
+        # in bytes/sec
+        return self.n_bytes / max(self.duration, 1e-3)
+
+
+def total_size(filenames):
+    return sum([os.path.getsize(fn) for fn in filenames])
+
+
+class CommandTransport(object):
+    """Copy files to the archive by running rsync or scp"""
+
+    def __init__(self, name, logger=None):
+        self.name = name
+        self.logger = logger if logger is not None else logging.getLogger("Transport")
+
+    def send(self, exposure, filenames):
+        cmd = exposure.transfer_command(filenames)
+        self.logger.info("Copying to archive using %s (%s)" % (self.name, " ".join(cmd)))
+        start_time = time.time()
+        returncode = exposure.execute(cmd, timeout=exposure.transfer_timeout)
+        return TransferResult(returncode == 0, total_size(filenames), time.time() - start_time,
+                              method=self.name)
+
+
+class LocalTransport(object):
+    """Copy files to a directory on this machine, to run (and benchmark) the
+    whole DTS without a network or an archive server. The server part of the
+    remote target, if any, is ignored"""
+
+    name = 'local'
+
+    def __init__(self, logger=None):
+        self.logger = logger if logger is not None else logging.getLogger("Transport")
+
+    def send(self, exposure, filenames):
+        directory = exposure.remote_target_directory.split(":", 1)[-1]
+        self.logger.info("Copying to local directory %s" % (directory))
+        start_time = time.time()
+        n_bytes = 0
+        try:
+            for fn in filenames:
+                target = os.path.join(directory, os.path.basename(fn))
+                # the file only gets its final name once complete
+                shutil.copyfile(fn, target+".part")
+                os.rename(target+".part", target)
+                n_bytes += os.path.getsize(target)
+        except (IOError, OSError) as e:
+            self.logger.error("Copying to %s failed: %s" % (directory, str(e)))
+            return TransferResult(False, n_bytes, time.time() - start_time, method=self.name)
+        return TransferResult(True, n_bytes, time.time() - start_time, method=self.name)
+
+
+class SFTPTransport(object):
+    """Copy files to the archive with an in-process SFTP client (paramiko).
+    Writes are pipelined, i.e. sent without waiting for the server to
+    acknowledge each of them, within a large flow-control window. The ssh
+    connection is kept open and shared by all transfers of this process"""
+
+    name = 'sftp'
+
+    BLOCK_SIZE = 2**20
+    WINDOW_SIZE = 32*2**20
+
+    connections = {}
+    connections_lock = threading.Lock()
+
+    def __init__(self, logger=None):
+        if (paramiko is None):
+            raise ValueError("SFTP transfers need paramiko")
+        self.logger = logger if logger is not None else logging.getLogger("Transport")
+
+    def connect(self, server, sshkey, timeout):
+        # returns the shared connection to server, opening it if needed
+        key = (server, sshkey)
+        with self.connections_lock:
+            client = self.connections.get(key)
+            if (client is not None and client.get_transport() is not None and
+                    client.get_transport().is_active()):
+                return client
+            username, hostname = server.split("@", 1) if "@" in server else (None, server)
+            port = 22
+            if (":" in hostname):
+                hostname, port = hostname.split(":", 1)
+            client = paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(paramiko.RejectPolicy())
+            client.connect(hostname, port=int(port), username=username, key_filename=sshkey,
+                           timeout=timeout)
+            client.get_transport().default_window_size = self.WINDOW_SIZE
+            client.get_transport().set_keepalive(30)
+            self.connections[key] = client
+            self.logger.info("Opened SFTP connection to %s" % (server))
+            return client
+
+    def disconnect(self, server, sshkey):
+        with self.connections_lock:
+            client = self.connections.pop((server, sshkey), None)
+        if (client is not None):
+            client.close()
+
+    def send(self, exposure, filenames):
+        server, directory = exposure.remote_target_directory.split(":", 1)
+        if (exposure.bandwidth_limit is not None):
+            self.logger.warning("SFTP transfers do not support a bandwidth limit, ignoring it")
+        start_time = time.time()
+        n_bytes = 0
+        try:
+            client = self.connect(server, exposure.sshkey, exposure.transfer_timeout)
+            sftp = client.open_sftp()
+            sftp.get_channel().settimeout(exposure.transfer_timeout)
+            try:
+                for fn in filenames:
+                    target = os.path.join(directory, os.path.basename(fn))
+                    self.logger.info("Copying to archive using SFTP (%s:%s)" % (server, target))
+                    with open(fn, "rb") as f, sftp.open(target+".part", "wb") as remote_file:
+                        remote_file.set_pipelined(True)
+                        while (True):
+                            block = f.read(self.BLOCK_SIZE)
+                            if (len(block) == 0):
+                                break
+                            remote_file.write(block)
+                    # closing waits for all outstanding writes
+                    size = os.path.getsize(fn)
+                    if (sftp.stat(target+".part").st_size != size):
+                        raise IOError("size of %s on the archive server does not match" % (target))
+                    sftp.posix_rename(target+".part", target)
+                    n_bytes += size
+            finally:
+                sftp.close()
+        except (IOError, OSError, EOFError, paramiko.SSHException) as e:
+            self.logger.error("SFTP transfer failed: %s" % (str(e)))
+            # start with a new connection next time
+            self.disconnect(server, exposure.sshkey)
+            return TransferResult(False, n_bytes, time.time() - start_time, method=self.name)
+        return TransferResult(True, n_bytes, time.time() - start_time, method=self.name)
+
+
+def get_transport(name, logger=None):
+    if (name in ['rsync', 'scp']):
+        return CommandTransport(name, logger=logger)
+    if (name == 'sftp'):
+        return SFTPTransport(logger=logger)
+    if (name == 'local'):
+        return LocalTransport(logger=logger)
+    raise ValueError("Unknown transfer protocol: %s" % (name))
@@ -0,0 +1,201 @@
+import os
+import time
+import shlex
+import threading
+import concurrent.futures
+import logging
+
+import dts_checksum
+import dts_supervisor
+
+
+class Verification(object):
+
+    def __init__(self, exposure, server, path):
+        self.exposure = exposure
+        self.server = server
+        self.path = path
+        self.future = concurrent.futures.Future()
+
+
+def parse_md5sum(output):
+    # md5sum output as path -> checksum
+    checksums = {}
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split(None, 1)
+        if (len(fields) != 2):
+            continue
+        # md5sum marks lines with escaped file names with a backslash
+        checksum, path = fields[0].lstrip("\\"), fields[1]
+        checksums[path[1:] if path.startswith("*") else path] = checksum
+    return checksums
+
+
+class RemoteVerifier(threading.Thread):
+    """Checks that the tar-balls on the archive server are identical to the
+    ones we sent, by comparing their MD5 with our own checksum. Transfers
+    finishing at about the same time are checked together with a single
+    md5sum call over one ssh session. This runs in the background, so
+    transfer workers can go on with the next exposure while the report stage
+    waits for the result, in a thread of its own (see report()).
+
+    Tar-balls that do not match are removed from the archive server, so
+    they are never ingested. The md5sum call of a batch is killed after
+    timeout seconds, so a stalled ssh session can not hold up the verifier
+    for longer than that."""
+
+    def __init__(self, max_batch=20, max_wait=2., timeout=600.):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.logger = logging.getLogger("Verifier")
+        self.cv = threading.Condition()
+        self.waiting = []
+        # a whole batch can wait for its result at the same time
+        self.reporters = concurrent.futures.ThreadPoolExecutor(max_workers=max_batch, thread_name_prefix="Report")
+        self.reports = set()
+        self.reports_lock = threading.Lock()
+
+    def result_timeout(self):
+        # how long to wait for the result of a verification: the batch it
+        # is part of, and one batch ahead of it
+        return self.max_wait + 2 * self.timeout
+
+    def submit(self, exposure):
+        # returns a future that is True once the archive has an identical
+        # copy of the tar-ball, False otherwise
+        server, path = exposure.remote_tar_location()
+        verification = Verification(exposure, server, path)
+        with self.cv:
+            self.waiting.append(verification)
+            self.cv.notify_all()
+        return verification.future
+
+    def report(self, exposure):
+        # runs the report stage of a verified exposure in the background;
+        # returns a future that is done once it is reported
+        with self.reports_lock:
+            reported = self.reporters.submit(exposure.report_stage)
+            self.reports.add(reported)
+        reported.add_done_callback(self.report_done)
+        return reported
+
+    def report_done(self, reported):
+        with self.reports_lock:
+            self.reports.discard(reported)
+
+    def wait_for_reports(self):
+        with self.reports_lock:
+            reports = list(self.reports)
+        concurrent.futures.wait(reports)
+
+    def run(self):
+        while (True):
+            with self.cv:
+                while (len(self.waiting) == 0):
+                    self.cv.wait()
+                # give other transfers finishing about now a chance to join
+                end_time = time.time() + self.max_wait
+                while (len(self.waiting) < self.max_batch and time.time() < end_time):
+                    self.cv.wait(timeout=end_time - time.time())
+                batch, self.waiting = self.waiting[:self.max_batch], self.waiting[self.max_batch:]
+
+            batches = {}
+            for verification in batch:
+                key = (verification.server, verification.exposure.sshkey)
+                batches.setdefault(key, []).append(verification)
+            for verifications in batches.values():
+                try:
+                    self.verify_batch(verifications)
+                except Exception as e:
+                    self.logger.error("Verifying tar-balls failed: %s" % (str(e)))
+                    for verification in verifications:
+                        if (not verification.future.done()):
+                            verification.future.set_result(False)
+
+    def remote_checksums(self, verifications):
+        leader = verifications[0].exposure
+        server = verifications[0].server
+        paths = [v.path for v in verifications]
+        if (server is None):
+            # local transfers
+            checksums = {}
+            for path in paths:
+                try:
+                    checksums[path] = dts_checksum.file_checksum(path)
+                except (IOError, OSError):
+                    pass
+            return checksums
+
+        cmd = leader.ssh_command() + [server, "md5sum %s" % (" ".join([shlex.quote(p) for p in paths]))]
+        try:
+            result = dts_supervisor.run(cmd, timeout=self.timeout, logger=self.logger)
+        except OSError as e:
+            self.logger.error("Unable to run md5sum on %s: %s" % (server, str(e)))
+            return {}
+        if (result.returncode != 0):
+            # missing files, but we still get the checksums of all others
+            self.logger.warning("md5sum on %s returned %d" % (server, result.returncode))
+        return parse_md5sum(result.stdout)
+
+    def verify_batch(self, verifications):
+        start_time = time.time()
+        checksums = self.remote_checksums(verifications)
+        self.logger.info("Checked %d tar-balls on %s in %.1f seconds" % (
+            len(verifications), verifications[0].server or "local disk", time.time() - start_time))
+
+        corrupt = []
+        for verification in verifications:
+            exposure = verification.exposure
+            exposure.remote_checksum = checksums.get(verification.path)
+            if (exposure.remote_checksum == exposure.tar_checksum):
+                exposure.logger.info("Checksum of tar-ball on archive server verified: %s" % (
+                    exposure.remote_checksum))
+            elif (exposure.remote_checksum is None):
+                exposure.logger.error("Unable to get checksum of %s from archive server" % (verification.path))
+            else:
+                exposure.logger.error("Checksum of tar-ball on archive server (%s) does not match ours (%s)" % (
+                    exposure.remote_checksum, exposure.tar_checksum))
+                corrupt.append(verification.path)
+
+        if (len(corrupt) > 0):
+            self.remove(verifications[0], corrupt)
+        for verification in verifications:
+            verification.future.set_result(verification.exposure.remote_checksum == verification.exposure.tar_checksum)
+
+    def remove(self, leader, paths):
+        self.logger.warning("Removing %d corrupt tar-balls: %s" % (len(paths), ", ".join(paths)))
+        if (leader.server is None):
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return
+        cmd = leader.exposure.ssh_command() + [
+            leader.server, "rm -f %s" % (" ".join([shlex.quote(p) for p in paths]))]
+        leader.exposure.execute(cmd, timeout=self.timeout)
+
+
+verifiers = {}
+verifiers_lock = threading.Lock()
+
+
+def open_verifier(max_wait, timeout):
+    # all exposures transferred by this process share the same verifier
+    key = (max_wait, timeout)
+    with verifiers_lock:
+        if (key not in verifiers):
+            verifiers[key] = RemoteVerifier(max_wait=max_wait, timeout=timeout)
+            verifiers[key].start()
+        return verifiers[key]
+
+
+def wait_for_reports():
+    # before exiting, let all exposures still being verified report
+    with verifiers_lock:
+        all_verifiers = list(verifiers.values())
+    for verifier in all_verifiers:
+        verifier.wait_for_reports()
@@ -0,0 +1,264 @@
+import os
+import time
+import json
+import fcntl
+import atexit
+import tempfile
+import threading
+import logging
+
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+INDEX_FILENAME = ".odi_dts_headers.json"
+
+
+def parse_value(card):
+    # value of a "KEYWORD = value / comment" card as str, bool, int or float
+    value = card[10:]
+    if (value.lstrip().startswith("'")):
+        # strings are quoted, with quotes inside escaped by doubling them
+        text = value.lstrip()[1:]
+        result = []
+        i = 0
+        while (i < len(text)):
+            if (text[i] == "'"):
+                if (text[i+1:i+2] == "'"):
+                    result.append("'")
+                    i += 2
+                    continue
+                break
+            result.append(text[i])
+            i += 1
+        return "".join(result).rstrip()
+
+    value = value.split("/", 1)[0].strip()
+    if (value == 'T'):
+        return True
+    if (value == 'F'):
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace('D', 'E'))
+    except ValueError:
+        return value if value != '' else None
+
+
+def data_size(cards):
+    # number of bytes of data following a header, padded to full blocks
+    naxis = cards.get('NAXIS', 0)
+    if (naxis == 0):
+        return 0
+    n_pixels = 1
+    for axis in range(1, naxis+1):
+        if (axis == 1 and naxis > 1 and cards.get('NAXIS1') == 0):
+            # random groups
+            continue
+        n_pixels *= cards.get('NAXIS%d' % (axis), 0)
+    n_bytes = abs(cards.get('BITPIX', 8)) // 8 * cards.get('GCOUNT', 1) * (cards.get('PCOUNT', 0) + n_pixels)
+    return (n_bytes + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+
+def read_header(f, keywords=()):
+    # read one header from the current position of f; returns a dictionary
+    # of the structural keywords, one of the requested keywords found, and
+    # the number of bytes read. The structural keywords are None if there is
+    # no END card before the end of the file
+    cards = {}
+    found = {}
+    n_bytes = 0
+    while (True):
+        block = f.read(BLOCK_SIZE)
+        if (len(block) < BLOCK_SIZE):
+            return None, found, n_bytes
+        n_bytes += BLOCK_SIZE
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[i:i+CARD_SIZE].decode('ascii', 'replace')
+            key = card[:8].rstrip()
+            if (key == 'END'):
+                return cards, found, n_bytes
+            if (card[8:10] != '= '):
+                continue
+            if (key in keywords):
+                found[key] = parse_value(card)
+            elif (key in ('BITPIX', 'GCOUNT', 'PCOUNT') or key.startswith('NAXIS')):
+                cards[key] = parse_value(card)
+
+
+def read_keywords(fn, keywords):
+    """Look for the given keywords in the headers of a FITS file, reading
+    nothing but the header blocks. Stops at the first header containing any
+    of them; returns a dictionary of the keywords found"""
+
+    keywords = set(keywords)
+    with open(fn, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while (offset + BLOCK_SIZE <= file_size):
+            f.seek(offset)
+            cards, found, n_bytes = read_header(f, keywords)
+            if (cards is None or len(found) > 0):
+                return found
+            offset += n_bytes + data_size(cards)
+    return {}
+
+
+def incomplete_reason(fn, file_size=None):
+    """Check that a FITS file is complete: every header ends with an END
+    card, and the file ends exactly after the data of the last HDU. Returns
+    None for complete files, or why the file is not complete"""
+
+    with open(fn, "rb") as f:
+        if (file_size is None):
+            file_size = os.fstat(f.fileno()).st_size
+        if (file_size == 0 or file_size % BLOCK_SIZE != 0):
+            return "size %d is not a multiple of %d" % (file_size, BLOCK_SIZE)
+        offset = 0
+        n_hdus = 0
+        while (offset < file_size):
+            f.seek(offset)
+            cards, _, n_bytes = read_header(f)
+            if (cards is None):
+                return "header %d has no END card" % (n_hdus)
+            offset += n_bytes + data_size(cards)
+            n_hdus += 1
+    if (offset > file_size):
+        return "data of HDU %d ends after the end of the file (%d > %d bytes)" % (
+            n_hdus-1, offset, file_size)
+    return None
+
+
+def read_keyword(fn, keyword):
+    return read_keywords(fn, [keyword]).get(keyword)
+
+
+class HeaderIndex(object):
+    """Header keywords read from FITS files earlier, kept in a small JSON file
+    so a file is only ever read once as long as its size and modification
+    time do not change. The index is shared by all processes using the same
+    file. New entries are written out in batches, every save_every of them
+    or save_interval seconds, and when the process exits."""
+
+    def __init__(self, filename, max_entries=100000, save_every=100, save_interval=60., logger=None):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.last_save = time.time()
+        self.logger = logger if logger is not None else logging.getLogger("HeaderIndex")
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.new_entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as f:
+                entries = json.load(f)
+        except (IOError, OSError):
+            entries = {}
+        except ValueError:
+            self.logger.warning("Ignoring corrupt header index %s" % (self.filename))
+            entries = {}
+        with self.lock:
+            self.entries = entries
+
+    def lookup(self, fn, keyword):
+        fn = os.path.abspath(fn)
+        stat = os.stat(fn)
+        with self.lock:
+            entry = self.entries.get(fn)
+            if (entry is not None and entry['size'] == stat.st_size and
+                    entry['mtime_ns'] == stat.st_mtime_ns and keyword in entry['keywords']):
+                self.hits += 1
+                return entry['keywords'][keyword]
+            self.misses += 1
+
+        # keywords not in the file are stored as None, so we never read
+        # this file again
+        value = read_keyword(fn, keyword)
+        with self.lock:
+            entry = self.entries.get(fn)
+            if (entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns):
+                entry = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, keywords={})
+            entry['keywords'][keyword] = value
+            self.entries[fn] = entry
+            self.new_entries[fn] = entry
+        return value
+
+    def save_if_needed(self):
+        # rewriting the whole index for every new file would cost more than
+        # reading the headers again
+        with self.lock:
+            n_new = len(self.new_entries)
+            due = (n_new >= self.save_every or
+                   (n_new > 0 and time.time() - self.last_save > self.save_interval))
+        if (due):
+            self.save()
+
+    def save(self):
+        with self.lock:
+            if (len(self.new_entries) == 0):
+                return
+            new_entries, self.new_entries = self.new_entries, {}
+            self.last_save = time.time()
+
+        # merge with what other processes added since we loaded the index
+        with open(self.filename+".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.load()
+                with self.lock:
+                    self.entries.update(new_entries)
+                    if (len(self.entries) > self.max_entries):
+                        # forget the files that were written longest ago
+                        by_age = sorted(self.entries, key=lambda fn: self.entries[fn]['mtime_ns'])
+                        for fn in by_age[:len(self.entries) - self.max_entries]:
+                            del self.entries[fn]
+                    content = json.dumps(self.entries)
+                fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)),
+                                                    suffix=".tmp")
+                with os.fdopen(fd, "w") as f:
+                    f.write(content)
+                os.rename(tmp_filename, self.filename)
+            except (IOError, OSError) as e:
+                self.logger.warning("Unable to save header index %s: %s" % (self.filename, str(e)))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def find_keyword(filenames, keyword, index=None):
+    # value of keyword from the first of the files that has it, or None
+    value = None
+    for fn in filenames:
+        try:
+            if (index is not None):
+                value = index.lookup(fn, keyword)
+            else:
+                value = read_keyword(fn, keyword)
+        except (IOError, OSError):
+            continue
+        if (value is not None):
+            break
+    if (index is not None):
+        index.save_if_needed()
+    return value
+
+
+indices = {}
+indices_lock = threading.Lock()
+
+
+def open_index(filename):
+    # all exposures handled by this process share the same index
+    with indices_lock:
+        if (filename not in indices):
+            indices[filename] = HeaderIndex(filename)
+            atexit.register(indices[filename].save)
+        return indices[filename]
@@ -4,10 +4,11 @@
 import argparse
 import os
 import glob
-import astropy.io.fits as pyfits
 
 from query_db import ODIDB
 import commandline
+import fits_header
+import config
 import cx_Oracle
 
 if __name__ == "__main__":
@@ -40,32 +41,32 @@ if __name__ == "__main__":
 
     # print(args.inputdir)
 
-    # get OBSIDs for all input files
+    # get OBSIDs for all input files; only the headers are read, and only
+    # for files not seen before
+    header_index = fits_header.open_index(
+        args.header_index if args.header_index is not None else
+        os.path.join(config.tar_scratchdir, fits_header.INDEX_FILENAME))
     obsids = []
     for fn in args.inputdir:
         if (os.path.isdir(fn)):
-            dirlist = glob.glob(fn + "/*.fits")
+            dirlist = sorted(glob.glob(fn + "/*.fits"))
             # print("Input was directory, checking files: %s" % (", ".join(dirlist)))
-            for _fn in dirlist:
-                hdulist = pyfits.open(_fn)
-                try:
-                    obsid = hdulist[0].header['OBSID']
-                    print("Found OBSID %s in %s" % (obsid, _fn))
-                    obsids.append(obsid)
-                    break
-                except KeyError:
-                        continue
+            obsid = fits_header.find_keyword(dirlist, 'OBSID', index=header_index)
+            if (obsid is not None):
+                print("Found OBSID %s in %s" % (obsid, fn))
+                obsids.append(obsid)
+            else:
+                print("Unable to get OBSID from %s" % (fn))
         elif (os.path.isfile(fn)):
-            try:
-                hdulist = pyfits.open(fn)
-                obsid = hdulist[0].header['OBSID']
-                print("Found OBSID %s in %s" % (obsid, _fn))
+            obsid = fits_header.find_keyword([fn], 'OBSID', index=header_index)
+            if (obsid is not None):
+                print("Found OBSID %s in %s" % (obsid, fn))
                 obsids.append(obsid)
-                break
-            except:
+            else:
                 print("Unable to get OBSID from %s" % (fn))
         else:
             print("Not sure what to do with %s" % (fn))
+    print("Read %d FITS headers, %d more from the header index" % (header_index.misses, header_index.hits))
 
     print("Adding resend requests for %s" % ("\n ** ".join(['']+obsids)))
 
@@ -0,0 +1,252 @@
+import os
+import sys
+import time
+import atexit
+import select
+import struct
+import ctypes
+import ctypes.util
+import tempfile
+import threading
+import concurrent.futures
+import logging
+
+import dts_checksum
+import dts_compress
+import dts_supervisor
+import fits_header
+
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """Minimal inotify interface through ctypes, just enough to learn about
+    new directories and files that were closed after writing"""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if (self.fd < 0):
+            e = ctypes.get_errno()
+            raise OSError(e, "inotify_init1: %s" % (os.strerror(e)))
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if (wd < 0):
+            e = ctypes.get_errno()
+            raise OSError(e, "inotify_add_watch: %s" % (os.strerror(e)), path)
+        self.watches[wd] = path
+        return wd
+
+    def read_events(self, timeout=1.):
+        # list of (directory, mask, name) of all events, waiting at most
+        # timeout seconds for the first
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if (len(readable) == 0):
+            return []
+        try:
+            buffer = os.read(self.fd, 256*1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while (offset + EVENT_HEADER.size <= len(buffer)):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset+length].rstrip(b"\0"))
+            offset += length
+            if (mask & IN_IGNORED):
+                # the directory is gone
+                self.watches.pop(wd, None)
+                continue
+            events.append((self.watches.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class AcquisitionWatcher(threading.Thread):
+    """Watches the acquisition directories for FITS files as soon as they are
+    written, and compresses them into the fz cache right away. Once the
+    database has the exposure, the DTS finds all compressed files in the cache
+    and only needs to tar and send them.
+
+    Compression is speculative: entries are keyed by size and modification
+    time, so files changed afterwards simply miss the cache. If more files
+    arrive than the workers can keep up with, the rest is left to the DTS."""
+
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, roots, fz_cache, compressor='fpack', n_workers=2, max_depth=3, max_pending=50):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.fz_cache = fz_cache
+        self.max_depth = max_depth
+        self.max_pending = max_pending
+        self.logger = logging.getLogger("Watcher")
+        self.compressor = dts_compress.get_compressor(compressor, execute=self.execute, logger=self.logger)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, n_workers))
+
+        self.inotify = Inotify()
+        self.depths = {}
+        self.cv = threading.Condition()
+        # files being compressed (or waiting to be)
+        self.pending = set()
+        self.shutdown = False
+        self.n_compressed = 0
+        self.n_skipped = 0
+
+        for root in self.roots:
+            self.watch_tree(root, 0, queue_files=False)
+
+    def execute(self, cmd, redirect_stdout=None, timeout=None):
+        try:
+            return dts_supervisor.run(cmd, stdout=redirect_stdout, timeout=timeout,
+                                      logger=self.logger).returncode
+        except OSError as e:
+            self.logger.critical("Execution failed: %s" % (str(e)))
+            return -1
+
+    def watch_tree(self, directory, depth, queue_files=True):
+        # watch a directory and all sub-directories up to max_depth; files
+        # already there are compressed as well if queue_files is set, as they
+        # might have been written before we started watching
+        try:
+            self.inotify.add_watch(directory, self.WATCH_MASK)
+        except OSError as e:
+            self.logger.warning("Unable to watch %s: %s" % (directory, str(e)))
+            return
+        self.depths[directory] = depth
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if (entry.is_dir(follow_symlinks=False)):
+                        if (depth < self.max_depth):
+                            self.watch_tree(entry.path, depth+1, queue_files)
+                    elif (queue_files):
+                        self.file_complete(entry.path)
+        except OSError:
+            pass
+
+    def run(self):
+        self.logger.info("Watching %s for new exposures" % (", ".join(self.roots)))
+        while (not self.shutdown):
+            for (directory, mask, name) in self.inotify.read_events(timeout=1.):
+                if (mask & IN_Q_OVERFLOW):
+                    self.logger.warning("Missed some file-system events, the DTS will compress these files")
+                    continue
+                if (directory is None or name == ''):
+                    continue
+                path = os.path.join(directory, name)
+                if (mask & IN_ISDIR):
+                    if (mask & (IN_CREATE | IN_MOVED_TO) and self.depths.get(directory, self.max_depth) < self.max_depth):
+                        self.logger.debug("New directory %s" % (path))
+                        self.watch_tree(path, self.depths[directory]+1)
+                elif (mask & (IN_CLOSE_WRITE | IN_MOVED_TO)):
+                    self.file_complete(path)
+        self.inotify.close()
+
+    def file_complete(self, path):
+        name = os.path.basename(path)
+        if (not name.endswith(".fits") or name.startswith(".")):
+            return
+        with self.cv:
+            if (path in self.pending):
+                return
+            if (len(self.pending) >= self.max_pending):
+                self.n_skipped += 1
+                return
+            self.pending.add(path)
+        self.pool.submit(self.precompress, path)
+
+    def precompress(self, path):
+        try:
+            key = self.fz_cache.key(path, self.compressor.settings())
+            if (key is None or self.fz_cache.lookup(key) is not None):
+                return
+            reason = fits_header.incomplete_reason(path)
+            if (reason is not None):
+                # closed, but not done yet; we will hear about it again
+                self.logger.debug("Not compressing %s yet: %s" % (path, reason))
+                return
+            start_time = time.time()
+            fd, tmp_file = tempfile.mkstemp(dir=self.fz_cache.directory, suffix=".pre")
+            try:
+                with dts_checksum.HashingWriter(os.fdopen(fd, "wb")) as writer:
+                    returncode = self.compressor.compress(path, writer)
+                if (returncode != 0):
+                    self.logger.warning("%s failed (%d) for %s" % (self.compressor.name, returncode, path))
+                elif (self.fz_cache.key(path, self.compressor.settings()) != key):
+                    # written to again while we were compressing it
+                    self.logger.debug("%s changed while compressing it" % (path))
+                else:
+                    self.fz_cache.store(key, tmp_file, writer.hexdigest())
+                    with self.cv:
+                        self.n_compressed += 1
+                    self.logger.info("Compressed %s ahead of time (%.1f seconds)" % (path, time.time() - start_time))
+            finally:
+                os.remove(tmp_file)
+        except Exception as e:
+            # never let a speculative compression take the watcher down
+            self.logger.warning("Unable to compress %s ahead of time: %s" % (path, str(e)))
+        finally:
+            with self.cv:
+                self.pending.discard(path)
+                self.cv.notify_all()
+
+    def wait_for(self, path, timeout=120.):
+        # wait until a file we are compressing is in the cache, so the DTS
+        # does not compress it a second time
+        end_time = time.time() + timeout
+        with self.cv:
+            while (path in self.pending and time.time() < end_time):
+                self.cv.wait(timeout=end_time - time.time())
+
+    def report(self):
+        with self.cv:
+            self.logger.info("Compressed %d files ahead of time, skipped %d while busy" % (
+                self.n_compressed, self.n_skipped))
+
+    def stop(self):
+        self.shutdown = True
+        self.pool.shutdown(wait=False)
+
+
+watchers = {}
+watchers_lock = threading.Lock()
+
+
+def open_watcher(roots, fz_cache, compressor, n_workers):
+    # all exposures handled by this process share the same watcher
+    key = tuple(roots)
+    with watchers_lock:
+        if (key not in watchers):
+            watcher = None
+            if (fz_cache is None):
+                logging.getLogger("Watcher").warning("Compressing files ahead of time needs a fz cache (--fzcache)")
+            elif (not sys.platform.startswith("linux")):
+                logging.getLogger("Watcher").warning("Watching for new files needs inotify (Linux)")
+            else:
+                try:
+                    watcher = AcquisitionWatcher(list(roots), fz_cache, compressor=compressor, n_workers=n_workers)
+                    watcher.start()
+                    atexit.register(watcher.report)
+                except OSError as e:
+                    logging.getLogger("Watcher").error("Unable to watch for new files: %s" % (str(e)))
+            watchers[key] = watcher
+        return watchers[key]
@@ -0,0 +1,159 @@
+import os
+import shutil
+import hashlib
+import threading
+import logging
+
+
+class FzCache(object):
+    """On-disk cache of compressed files and their MD5 checksums, so
+    re-sending an exposure does not have to compress all its files again.
+
+    Entries are keyed by the path, size and modification time of the raw
+    file and by the compressor settings, so any change to the file or to the
+    compression invalidates them. Once the cache grows beyond max_bytes the
+    least recently used entries are removed."""
+
+    def __init__(self, directory, max_bytes, logger=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.logger = logger if logger is not None else logging.getLogger("FzCache")
+        self.lock = threading.Lock()
+
+        if (not os.path.isdir(self.directory)):
+            os.makedirs(self.directory)
+        self.total_bytes = sum([size for (_, size, _) in self.list_entries()])
+        self.logger.info("Using fz cache in %s (%.1f of %.1f GB in use)" % (
+            self.directory, self.total_bytes / 2**30, self.max_bytes / 2**30))
+
+    def key(self, in_file, settings, stat=None):
+        # stat is the size and modification time (in ns), if already known
+        if (stat is None):
+            try:
+                st = os.stat(in_file)
+            except OSError:
+                return None
+            stat = (st.st_size, st.st_mtime_ns)
+        key_string = "%s|%d|%d|%s" % (os.path.abspath(in_file), stat[0], stat[1], settings)
+        return hashlib.sha1(key_string.encode('utf-8')).hexdigest()
+
+    def entry_filenames(self, key):
+        base = os.path.join(self.directory, key)
+        return base+".fz", base+".md5"
+
+    def lookup(self, key):
+        # returns the filename of the cached compressed file and its MD5, or
+        # None if the file is not in the cache
+        if (key is None):
+            return None
+        fz_file, md5_file = self.entry_filenames(key)
+        try:
+            with open(md5_file, "r") as f:
+                md5 = f.read().strip()
+            # mark this entry as recently used
+            os.utime(fz_file)
+        except (IOError, OSError):
+            return None
+        return fz_file, md5
+
+    def open(self, key):
+        # like lookup, but returns the filename, the open compressed file
+        # and its MD5. The file is opened while holding the lock, so it can
+        # still be read if the entry gets evicted right after
+        if (key is None):
+            return None
+        fz_file, md5_file = self.entry_filenames(key)
+        with self.lock:
+            try:
+                with open(md5_file, "r") as f:
+                    md5 = f.read().strip()
+                fz = open(fz_file, "rb")
+                os.utime(fz_file)
+            except (IOError, OSError):
+                return None
+        return fz_file, fz, md5
+
+    def store(self, key, src, md5):
+        # add a compressed file to the cache; src is either a filename (that
+        # gets hard-linked if possible) or a file object positioned at the start
+        if (key is None):
+            return
+        fz_file, md5_file = self.entry_filenames(key)
+        tmp_file = "%s.%d.%d.tmp" % (fz_file, os.getpid(), threading.get_ident())
+        try:
+            if (isinstance(src, str)):
+                try:
+                    os.link(src, tmp_file)
+                except OSError:
+                    shutil.copyfile(src, tmp_file)
+            else:
+                with open(tmp_file, "wb") as f:
+                    shutil.copyfileobj(src, f)
+            size = os.path.getsize(tmp_file)
+        except (IOError, OSError) as e:
+            self.logger.warning("Unable to add file to fz cache: %s" % (str(e)))
+            if (os.path.exists(tmp_file)):
+                os.remove(tmp_file)
+            return
+
+        with self.lock:
+            try:
+                with open(md5_file, "w") as f:
+                    f.write(md5)
+                # the entry only becomes visible once it is complete
+                os.rename(tmp_file, fz_file)
+            except (IOError, OSError) as e:
+                self.logger.warning("Unable to add file to fz cache: %s" % (str(e)))
+            if (os.path.exists(tmp_file)):
+                # rename does nothing if both are links to the same file
+                os.remove(tmp_file)
+            self.total_bytes += size
+            if (self.total_bytes > self.max_bytes):
+                self.evict()
+
+    def list_entries(self):
+        # (key, size, last use) of all complete entries
+        entries = []
+        for fn in os.listdir(self.directory):
+            if (not fn.endswith(".fz")):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, fn))
+            except OSError:
+                continue
+            entries.append((fn[:-3], st.st_size, st.st_mtime))
+        return entries
+
+    def evict(self):
+        # drop the least recently used entries until we are below 90% of the
+        # budget, so we do not have to do this again for every new entry
+        entries = sorted(self.list_entries(), key=lambda e: e[2])
+        self.total_bytes = sum([size for (_, size, _) in entries])
+        target = 0.9 * self.max_bytes
+        n_removed = 0
+        for (key, size, _) in entries:
+            if (self.total_bytes <= target):
+                break
+            for fn in self.entry_filenames(key):
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+            self.total_bytes -= size
+            n_removed += 1
+        self.logger.info("Evicted %d files from fz cache, %.1f GB left" % (
+            n_removed, self.total_bytes / 2**30))
+
+
+caches = {}
+caches_lock = threading.Lock()
+
+
+def open_cache(directory, max_bytes):
+    # all exposures transferred by this process share the same cache
+    if (directory is None):
+        return None
+    with caches_lock:
+        if (directory not in caches):
+            caches[directory] = FzCache(directory, max_bytes)
+        return caches[directory]
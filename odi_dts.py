@@ -12,6 +12,18 @@ import queue
 import logging
 
 import dts
+import dts_pipeline
+import dts_concurrency
+import fz_cache
+import scratch_manager
+import dts_bundle
+import ssh_pool
+import fits_header
+import fs_watcher
+import dts_delta
+import dts_verify
+import dts_compress
+import dts_scheduler
 import query_db
 import dts_logger
 import config
@@ -20,9 +32,48 @@ import db_watcher
 import ppa_resend_request_listener
 import ppa_sender
 
+def start_dts(exposure_info, database, ppa, delete_when_done, dts_options, auto_start=True):
+
+    (dir, obsid, extra) = exposure_info
+    logger = logging.getLogger("DTS")
+    try:
+        exposure2archive = dts.DTS(dir, obsid=obsid, database=database,
+                                   cleanup=delete_when_done,
+                                   extra=extra,
+                                   ppa=ppa,
+                                   auto_start=auto_start,
+                                   **dts_options)
+    except ValueError as v:
+        logger.error("ERROR starting DTS for OBSID %s in %s" % (obsid, dir))
+        print("------------------------------------")
+        print(v)
+        print("------------------------------------")
+        print("------------------------------------")
+        print(traceback.format_exc())
+        print("------------------------------------")
+        if (not os.path.isdir(dir) and obsid is not None):
+            # Directory is missing
+            # mark this exposure as problematic but done to avoid
+            # running into the same problem again when we check the
+            # database again.
+            event_report = "pyDTS ERROR %s: directory %s not found :: 0" % (
+                obsid, dir
+            )
+            database.mark_exposure_archived(
+                obsid=obsid, event=event_report)
+            # print("**** pyDTS ERROR %s: directory %s not found :: 0" % (obsid, dir))
+        return None
+
+    if (not hasattr(exposure2archive, "filelist")):
+        # DTS gave up early as it could not find the exposure directory
+        return None
+    return exposure2archive
+
+
 class DTS_Thread(threading.Thread):
     """Threaded Url Grab"""
-    def __init__(self, queue, out_queue=None, database=None, delete_when_done=True, ppa=None):
+    def __init__(self, queue, out_queue=None, database=None, delete_when_done=True, ppa=None,
+                 dts_options=None, on_done=None, controller=None, scheduler=None, retry_deferred=None):
         threading.Thread.__init__(self)
         self.queue = queue
         self.out_queue = out_queue
@@ -30,47 +81,185 @@ class DTS_Thread(threading.Thread):
         self.delete_when_done = delete_when_done
         self.logger = logging.getLogger("DTS")
         self.ppa = ppa
+        self.dts_options = dts_options if dts_options is not None else {}
+        self.on_done = on_done
+        self.controller = controller
+        self.scheduler = scheduler
+        # seconds to wait before trying exposures that are not completely
+        # written yet again; if None, they are left for the next database check
+        self.retry_deferred = retry_deferred
         print("DTS_Thread init, database: " + str(database))
 
     def run(self):
         while(True):
+            if (self.controller is not None):
+                # wait until we are one of the workers allowed to run
+                self.controller.limiter.acquire()
+
             #grabs host from queue
             try:
                 exposure_info = self.queue.get()
             except queue.Empty as e:
                 break
             if (exposure_info is None):
+                if (self.controller is not None):
+                    self.controller.limiter.release()
                 break
 
-            (dir, obsid, extra) = exposure_info
+            dts_options = self.dts_options
+            if (self.scheduler is not None):
+                # e.g. the bandwidth limit of this exposure's class
+                dts_options = dict(dts_options, **self.scheduler.dts_options(exposure_info))
+
+            exposure = None
             try:
-                exposure2archive = dts.DTS(dir, obsid=obsid, database=self.database,
-                                           cleanup=self.delete_when_done,
-                                           extra=extra,
-                                           ppa=self.ppa)
-            except ValueError as v:
-                self.logger.error("ERROR starting DTS for OBSID %s in %s" % (obsid, dir))
-                print("------------------------------------")
-                print(v)
-                print("------------------------------------")
-                print("------------------------------------")
-                print(traceback.format_exc())
-                print("------------------------------------")
-                if (not os.path.isdir(dir) and obsid is not None):
-                    # Directory is missing
-                    # mark this exposure as problematic but done to avoid
-                    # running into the same problem again when we check the
-                    # database again.
-                    event_report = "pyDTS ERROR %s: directory %s not found :: 0" % (
-                        obsid, dir
-                    )
-                    self.database.mark_exposure_archived(
-                        obsid=obsid, event=event_report)
-                    # print("**** pyDTS ERROR %s: directory %s not found :: 0" % (obsid, dir))
+                exposure = start_dts(exposure_info, database=self.database, ppa=self.ppa,
+                                     delete_when_done=self.delete_when_done,
+                                     dts_options=dts_options)
+                while (exposure is not None and exposure.deferred is not None and
+                       self.retry_deferred is not None):
+                    self.logger.info("Trying %s again in %d seconds" % (exposure.obsid, self.retry_deferred))
+                    time.sleep(self.retry_deferred)
+                    exposure = start_dts(exposure_info, database=self.database, ppa=self.ppa,
+                                         delete_when_done=self.delete_when_done,
+                                         dts_options=dts_options)
+            except Exception:
+                # keep this worker alive for the next exposure
+                self.logger.error("ERROR transferring %s:\n%s" % (
+                    str(exposure_info), traceback.format_exc()))
+            finally:
+                if (self.controller is not None):
+                    self.controller.limiter.release()
+                if (exposure is not None and exposure.reported is not None):
+                    # the exposure is reported once its tar-ball is verified,
+                    # this worker goes on with the next one in the meantime
+                    exposure.reported.add_done_callback(
+                        lambda reported, exposure=exposure, exposure_info=exposure_info:
+                        self.exposure_reported(exposure_info, exposure, reported))
+                else:
+                    self.exposure_reported(exposure_info, exposure)
 
             #signals to queue job is done
             self.queue.task_done()
 
+    def exposure_reported(self, exposure_info, exposure, reported=None):
+        if (reported is not None and reported.exception() is not None):
+            self.logger.error("ERROR reporting %s: %s" % (str(exposure_info), str(reported.exception())))
+        if (self.controller is not None):
+            self.controller.record_exposure(exposure)
+        if (self.on_done is not None):
+            self.on_done(exposure_info)
+
+
+
+def open_header_index(args):
+    return fits_header.open_index(
+        args.header_index if args.header_index is not None else
+        os.path.join(config.tar_scratchdir, fits_header.INDEX_FILENAME))
+
+
+def dts_options_from_args(args):
+    # collect all command-line options that are handed through to each DTS
+    cache = fz_cache.open_cache(args.fzcache, args.fzcache_size * 2**30)
+    return dict(
+        fpack_threads=args.fpack_threads,
+        compressor=args.compressor,
+        packaging=args.packaging,
+        stream_spool_size=int(args.spool_size * 2**20),
+        transfer_protocol=args.protocol,
+        sshkey=args.sshkey,
+        transfer_timeout=args.transfer_timeout,
+        transfer_retries=args.transfer_retries,
+        verifier=dts_verify.open_verifier(args.verify_wait, args.verify_timeout) if args.verify else None,
+        fz_cache=cache,
+        scratch_manager=scratch_manager.open_manager(
+            config.tar_scratchdir, budget=args.scratch_budget * 2**30) if args.scratch_budget is not None else None,
+        bundler=dts_bundle.open_bundler(
+            args.bundle_size * 2**20, args.bundle_count, args.bundle_wait) if args.bundle else None,
+        ssh_pool=ssh_pool.open_pool(
+            config.remote_server, args.ssh_connections, args.sshkey) if args.ssh_connections > 0 else None,
+        transfer_streams=args.nstreams,
+        extra_digest=args.extra_digest,
+        header_index=open_header_index(args),
+        precompressor=fs_watcher.open_watcher(
+            args.watch_dirs, cache, args.compressor, args.fpack_threads) if args.watch_dirs else None,
+        check_complete=args.check_complete,
+        settle_time=args.settle_time,
+        incomplete_timeout=args.incomplete_timeout * 60.,
+        shipment_log=dts_delta.open_log(
+            args.shipment_log if args.shipment_log is not None else
+            os.path.join(config.tar_scratchdir, ".odi_dts_shipped")) if args.delta_resend else None,
+    )
+
+
+def make_controller(args, dts_queue):
+    # returns the number of worker threads to start, and the controller
+    # adjusting how many of them are active (if any)
+    if (not args.adaptive):
+        return args.nthreads, None
+    max_threads = args.max_threads if args.max_threads is not None else 2 * args.nthreads
+    controller = dts_concurrency.AdaptiveController(
+        limiter=dts_concurrency.ConcurrencyLimiter(args.nthreads),
+        min_threads=args.min_threads, max_threads=max_threads,
+        work_waiting=lambda: dts_queue.qsize() > 0,
+        interval=args.adapt_interval,
+    )
+    controller.logger.info("Adaptive mode: starting with %d workers, allowing %d to %d" % (
+        controller.limiter.limit, controller.min_threads, controller.max_threads))
+    controller.start()
+    return controller.max_threads, controller
+
+
+def dts_stage(name):
+    # run one of the stages of a DTS as part of the pipeline
+    def run_stage(exposure):
+        getattr(exposure, "%s_stage" % (name))()
+        return exposure
+    return run_stage
+
+
+def dts_stage_failed(item, stage, e):
+    if (stage in ['scan', 'report']):
+        return None
+    # let the report stage take care of the failed exposure
+    item.abort("%s stage failed: %s" % (stage, str(e)))
+    return item
+
+
+def make_pipeline(database, ppa, args, on_done=None):
+
+    dts_options = dts_options_from_args(args)
+
+    def scan(exposure_info):
+        return start_dts(exposure_info, database=database, ppa=ppa,
+                         delete_when_done=args.delete_when_done,
+                         dts_options=dts_options, auto_start=False)
+
+    workers = dict(scan=1, compress=2, tar=2, transfer=args.nthreads, report=1)
+    for stage_workers in args.stage_workers.split(","):
+        if (stage_workers.strip() == ''):
+            continue
+        name, n = stage_workers.split("=")
+        if (name not in workers):
+            raise ValueError("Unknown pipeline stage: %s" % (name))
+        workers[name] = int(n)
+
+    pipeline = dts_pipeline.DTS_Pipeline(
+        stages=[
+            ('scan', scan, workers['scan']),
+            ('compress', dts_stage('compress'), workers['compress']),
+            ('tar', dts_stage('tar'), workers['tar']),
+            ('transfer', dts_stage('transfer'), workers['transfer']),
+            ('report', dts_stage('report'), workers['report']),
+        ],
+        queue_depth=args.queue_depth,
+        on_done=on_done,
+        on_error=dts_stage_failed,
+    )
+    pipeline.logger.info("Starting pipeline with %s" % (
+        ", ".join(["%s=%d" % (s.name, s.n_workers) for s in pipeline.stages])))
+    pipeline.start()
+    return pipeline
 
 
 def transfer_onetime(odidb, ppa, args):
@@ -103,18 +292,40 @@ def transfer_onetime(odidb, ppa, args):
             #
             input_dirs = [(dir,None) for dir in args.inputdir]
 
+        if (args.pipeline):
+            if (args.adaptive):
+                logging.getLogger("ODI-DTS").warning("--adaptive is ignored in pipeline mode")
+
+            def retry_deferred(exposure):
+                if (isinstance(exposure, dts.DTS) and exposure.deferred is not None):
+                    logging.getLogger("ODI-DTS").info("Trying %s again in %d seconds" % (
+                        exposure.obsid, args.defer_wait))
+                    pipeline.put_later((exposure.exposure_directory, exposure.obsid, exposure.extra),
+                                       args.defer_wait)
+
+            pipeline = make_pipeline(odidb, ppa, args, on_done=retry_deferred)
+            for (dir, obsid) in input_dirs:
+                pipeline.put((dir, obsid, None))
+            pipeline.join()
+            pipeline.stop()
+            return
+
         # create a work-queue and populate it with exposures to archive
         for (dir, obsid) in input_dirs:
-            dts_queue.put((dir, obsid))
+            dts_queue.put((dir, obsid, None))
 
         #
         # Start the worker threads
         #
         threads = []
-        threads_needed = args.nthreads  # if args.nthreads < len(input_dirs) else len(input_dirs)
+        threads_needed, controller = make_controller(args, dts_queue)
         for i in range(threads_needed):
             t = DTS_Thread(queue=dts_queue, database=odidb,
-                           delete_when_done=args.delete_when_done)
+                           delete_when_done=args.delete_when_done,
+                           ppa=ppa,
+                           dts_options=dts_options_from_args(args),
+                           controller=controller,
+                           retry_deferred=args.defer_wait)
             t.setDaemon(True)
             t.start()
             threads.append(t)
@@ -125,6 +336,7 @@ def transfer_onetime(odidb, ppa, args):
         # join threads to wait until all are shutdown
         for t in threads:
             t.join()
+        dts_verify.wait_for_reports()
 
             #
             # start the worker threads
@@ -151,21 +363,73 @@ class DTS_ExposureSender(threading.Thread):
             odidb = query_db.ODIDB()
         self.odidb = odidb
         self.ppa = ppa
-        self.dts_queue = queue.Queue()
         self.args = args
         self.logger = logging.getLogger("ExposureSender")
 
+        self.scheduler = None
+        score = None
+        if (args.sjf):
+            # small exposures first, unless large ones have been waiting for too long
+            score = dts_scheduler.shortest_job_first(args.aging_rate * 2**20)
+            self.scheduler = dts_scheduler.PriorityExposureQueue(score)
+        if (args.qos):
+            # share the workers between fresh data, calibrations, resends and backfill
+            self.scheduler = dts_scheduler.QoSScheduler(
+                weights=dts_scheduler.parse_class_values(args.qos_weights),
+                bandwidth_limits=dts_scheduler.parse_class_values(args.qos_bwlimit),
+                backfill_age=args.backfill_age * 3600.,
+                score=score,
+                header_index=open_header_index(args))
+            self.logger.info("Scheduling exposures by class, weights: %s, bandwidth limits: %s" % (
+                self.scheduler.weights, self.scheduler.bandwidth_limits))
+        self.dts_queue = self.scheduler if self.scheduler is not None else queue.Queue()
+
+        # all exposures that are queued or being worked on, by OBSID
+        self.in_flight = {}
+        # when exposures finished, to spot database rows that were read
+        # before they were marked as archived
+        self.finished = {}
+        self.in_flight_cv = threading.Condition()
+
+        self.pipeline = None
+        if (args.pipeline):
+            if (args.adaptive or args.qos or args.sjf):
+                self.logger.warning("--adaptive, --qos and --sjf are ignored in pipeline mode")
+            self.pipeline = make_pipeline(self.odidb, self.ppa, self.args,
+                                          on_done=self.exposure_done)
+
         self.shutdown = False
         self.setDaemon(True)
 
+    def start_workers(self):
+        # these workers keep running for as long as we do
+        self.threads = []
+        n_threads, self.controller = make_controller(self.args, self.dts_queue)
+        for i in range(n_threads):
+            t = DTS_Thread(queue=self.dts_queue, database=self.odidb,
+                           delete_when_done=self.args.delete_when_done,
+                           ppa=self.ppa,
+                           dts_options=dts_options_from_args(self.args),
+                           on_done=self.exposure_done,
+                           controller=self.controller,
+                           scheduler=self.scheduler,
+                           )
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
     def run(self):
         self.logger.info("Starting up the DTS ExposureSender process")
+        if (self.pipeline is None):
+            self.start_workers()
+
         while (not self.shutdown):
 
             #
             # Check for new exposures
             #
             self.logger.info("Checking for new exposures")
+            query_time = time.time()
             exposures = self.odidb.query_exposures_for_transfer(
                 timeframe=self.args.timeframe,
                 include_resends=True
@@ -181,66 +445,89 @@ class DTS_ExposureSender(threading.Thread):
                         "No files to transfer at %s, checking again soon\n" % (
                         str(datetime.datetime.now())))
                     sys.stdout.flush()
-                delay = 0
-                while (delay < self.args.checkevery and not self.shutdown):
-                    time.sleep(0.1)
-                    delay += 0.1
-                continue
 
-            #
-            # Limit the number of exposures to be worked on in parallel
-            #
-            truncated_list = False
-            if (len(input_dirs) > self.args.chunksize):
-                truncated_list = True
-                logger.info("Limiting work to %d exposures (out of %d)" % (
-                    self.args.chunksize, len(input_dirs)
-                ))
-            input_dirs = input_dirs[:self.args.chunksize]
+            backlog = self.queue_exposures(input_dirs, query_time)
+            self.wait_for_next_check(backlog)
 
-            #
-            # create a work-queue and populate it with exposures to archive
-            #
-            for (dir, obsid, extra) in input_dirs:
-                # print(dir, obsid)
-                self.dts_queue.put((dir, obsid, extra))
+    def queue_exposures(self, input_dirs, query_time=None):
 
-            #
-            # Start the worker threads
-            #
-            self.threads = []
-            threads_needed = self.args.nthreads  # if args.nthreads < len(input_dirs) else len(input_dirs)
-            for i in range(threads_needed):
-                t = DTS_Thread(queue=self.dts_queue, database=self.odidb,
-                               delete_when_done=self.args.delete_when_done,
-                               ppa=self.ppa,
-                               )
-                t.setDaemon(True)
-                t.start()
-                self.threads.append(t)
-
-                # send the queue termination message
-                self.dts_queue.put(None)
-
-            # join threads to wait until all are shutdown
-            for t in self.threads:
-                while (not self.shutdown and t.is_alive()):
-                    t.join(timeout=0.1)
-
-            # wait a little before checking again for more frames.
-            time.sleep(0.002) # flush out log messages
-            print("Checking for new frames after short break")
-            if (not truncated_list):
-                delay = 0
-                while (delay < self.args.checkevery and not self.shutdown):
-                    delay += 0.1
-                    time.sleep(0.1)
+        #
+        # Only queue exposures we are not already working on, and limit the
+        # number of exposures to be worked on in parallel
+        #
+        with self.in_flight_cv:
+            input_dirs = [exposure_info for exposure_info in input_dirs
+                          if exposure_info[1] not in self.in_flight]
+            if (query_time is not None):
+                # exposures that finished after we asked the database are
+                # still listed; they show up correctly in the next check
+                input_dirs = [exposure_info for exposure_info in input_dirs
+                              if self.finished.get(exposure_info[1], 0) < query_time]
+                self.finished = dict([(obsid, t) for (obsid, t) in self.finished.items() if t >= query_time])
+        if (self.scheduler is not None):
+            # if we can not take all of them, take the most urgent ones
+            input_dirs = sorted(input_dirs, key=self.scheduler.priority)
+
+        new_exposures = []
+        backlog = False
+        with self.in_flight_cv:
+            for exposure_info in input_dirs:
+                (dir, obsid, extra) = exposure_info
+                if (obsid in self.in_flight):
+                    continue
+                if (len(self.in_flight) >= self.args.chunksize):
+                    backlog = True
+                    break
+                self.in_flight[obsid] = time.time()
+                new_exposures.append(exposure_info)
+            n_in_flight = len(self.in_flight)
+
+        if (len(new_exposures) > 0):
+            self.logger.info("Queueing %d new exposures (%d in flight%s)" % (
+                len(new_exposures), n_in_flight,
+                ", limited to %d" % (self.args.chunksize) if backlog else ""))
+
+        #
+        # Hand the new exposures to the workers
+        #
+        for exposure_info in new_exposures:
+            if (self.pipeline is not None):
+                self.pipeline.put(exposure_info)
+            else:
+                self.dts_queue.put(exposure_info)
+
+        return backlog
+
+    def exposure_done(self, item):
+        # called by the workers once an exposure is complete (or has failed)
+        obsid = item.obsid if isinstance(item, dts.DTS) else item[1]
+        with self.in_flight_cv:
+            self.in_flight.pop(obsid, None)
+            self.finished[obsid] = time.time()
+            self.in_flight_cv.notify_all()
+
+    def wait_for_next_check(self, backlog):
+        # If there are more exposures than we could queue, check again as soon
+        # as there is room, otherwise wait a little before checking again
+        end_time = time.time() + self.args.checkevery
+        with self.in_flight_cv:
+            while (not self.shutdown and time.time() < end_time):
+                if (backlog and len(self.in_flight) < self.args.chunksize):
+                    break
+                self.in_flight_cv.wait(timeout=0.1)
 
 
 if __name__ == "__main__":
 
     args = commandline.parse()
 
+    try:
+        # rather than failing every exposure later, e.g. without astropy
+        dts_compress.get_compressor(args.compressor, execute=None)
+    except ValueError as e:
+        print("ERROR: %s" % (str(e)))
+        sys.exit(1)
+
     # setup logging
     dtslog = dts_logger.dts_logging()
 
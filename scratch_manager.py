@@ -0,0 +1,207 @@
+import os
+import glob
+import json
+import time
+import fcntl
+import shutil
+import threading
+import logging
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def disk_usage(path):
+    # number of bytes used by a file or a directory tree
+    if (os.path.isfile(path)):
+        return os.path.getsize(path)
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for fn in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, fn))
+            except OSError:
+                pass
+    return total
+
+
+class ScratchManager(object):
+    """Keeps track of the space all exposures being worked on need in the
+    scratch directory, and only lets an exposure start once its estimated
+    footprint fits the budget.
+
+    All reservations are kept in a registry file in the scratch directory,
+    shared by all DTS processes on this machine. Entries of processes that
+    are no longer running mark files orphaned by a crash, which get removed
+    on startup; files kept on purpose (--keep) stay and count towards the
+    budget until they are deleted."""
+
+    REGISTRY_FILENAME = ".odi_dts_scratch.json"
+
+    # expected size of fpack output relative to the raw data, erring on the
+    # safe side
+    COMPRESSION_RATIO = 0.6
+
+    def __init__(self, scratch_dir, budget=None, logger=None):
+        self.scratch_dir = scratch_dir
+        self.budget = budget
+        self.logger = logger if logger is not None else logging.getLogger("Scratch")
+        self.registry_filename = os.path.join(self.scratch_dir, self.REGISTRY_FILENAME)
+        self.cv = threading.Condition()
+
+        self.sweep_orphans()
+        self.report()
+
+    def update_registry(self, function):
+        # run function on the content of the registry while holding an
+        # exclusive lock, and write back what it returns
+        with open(self.registry_filename, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                try:
+                    registry = json.loads(content) if content.strip() != '' else {}
+                except ValueError:
+                    self.logger.warning("Ignoring corrupt scratch registry %s" % (self.registry_filename))
+                    registry = {}
+                registry, result = function(registry)
+                f.seek(0)
+                f.truncate()
+                json.dump(registry, f, indent=1)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    def entry_paths(self, dir_name):
+        return [os.path.join(self.scratch_dir, dir_name),
+                os.path.join(self.scratch_dir, dir_name+".tar")] + \
+            glob.glob(os.path.join(glob.escape(self.scratch_dir), glob.escape(dir_name)+".delta*.tar"))
+
+    def sweep_orphans(self):
+
+        def sweep(registry):
+            removed = []
+            for dir_name, entry in list(registry.items()):
+                if (entry['keep']):
+                    if (not any([os.path.exists(p) for p in self.entry_paths(dir_name)])):
+                        # somebody cleaned up the files we kept
+                        del registry[dir_name]
+                    continue
+                if (pid_alive(entry['pid'])):
+                    continue
+                for path in self.entry_paths(dir_name):
+                    if (os.path.isdir(path)):
+                        shutil.rmtree(path, ignore_errors=True)
+                    elif (os.path.isfile(path)):
+                        os.remove(path)
+                removed.append("%s (%s)" % (dir_name, entry['obsid']))
+                del registry[dir_name]
+            return registry, removed
+
+        removed = self.update_registry(sweep)
+        if (len(removed) > 0):
+            self.logger.info("Removed scratch files orphaned by earlier runs: %s" % (", ".join(removed)))
+
+    def estimate(self, exposure):
+        # estimated number of bytes an exposure needs in the scratch directory
+        compressed = 0
+        for entry in exposure.manifest.entries:
+            compressed += int(entry.size * self.COMPRESSION_RATIO) if entry.compress else entry.size
+        if (exposure.packaging == 'files'):
+            # compressed files in the tar-prep directory, plus the tar-ball
+            return 2 * compressed
+        if (exposure.transfer_protocol == 'stream'):
+            # nothing but files too large to spool in memory
+            return min(compressed, 2 * exposure.fpack_threads * exposure.stream_spool_size)
+        return compressed
+
+    def reserve(self, exposure):
+        # blocks until there is room for this exposure in the scratch directory
+        n_bytes = self.estimate(exposure)
+        entry = dict(pid=os.getpid(), obsid=exposure.obsid, bytes=n_bytes,
+                     keep=False, time=time.time())
+
+        def try_reserve(registry):
+            in_use = sum([e['bytes'] for e in registry.values()])
+            if (self.budget is not None and in_use + n_bytes > self.budget and
+                    len([e for e in registry.values() if not e['keep']]) > 0):
+                return registry, (False, in_use)
+            # with nothing else running we have to go ahead, even if this
+            # exposure does not fit on its own
+            registry[exposure.dir_name] = entry
+            return registry, (True, in_use + n_bytes)
+
+        waiting_since = None
+        while (True):
+            admitted, in_use = self.update_registry(try_reserve)
+            if (admitted):
+                break
+            if (waiting_since is None):
+                waiting_since = time.time()
+                self.logger.info("Waiting for %.1f GB of scratch space for %s (%.1f of %.1f GB in use)" % (
+                    n_bytes / 2**30, exposure.obsid, in_use / 2**30, self.budget / 2**30))
+                self.report()
+            # other processes might release space as well, so check every now and then
+            with self.cv:
+                self.cv.wait(timeout=5)
+
+        if (self.budget is not None and in_use > self.budget):
+            self.logger.warning("Exceeding scratch budget of %.1f GB for %s" % (
+                self.budget / 2**30, exposure.obsid))
+        self.logger.info("Reserved %.1f GB of scratch space for %s%s, %.1f GB in use" % (
+            n_bytes / 2**30, exposure.obsid,
+            " after waiting %.0f seconds" % (time.time() - waiting_since) if waiting_since is not None else "",
+            in_use / 2**30))
+
+    def release(self, exposure, keep=False):
+        # files we keep continue to count with their actual size
+
+        def release_entry(registry):
+            if (exposure.dir_name not in registry):
+                return registry, None
+            if (keep):
+                registry[exposure.dir_name]['keep'] = True
+                registry[exposure.dir_name]['bytes'] = sum(
+                    [disk_usage(p) for p in self.entry_paths(exposure.dir_name) if os.path.exists(p)])
+            else:
+                del registry[exposure.dir_name]
+            return registry, None
+
+        self.update_registry(release_entry)
+        with self.cv:
+            self.cv.notify_all()
+
+    def report(self):
+        registry = self.update_registry(lambda registry: (registry, registry))
+        active = [(d, e) for (d, e) in registry.items() if not e['keep']]
+        kept = [(d, e) for (d, e) in registry.items() if e['keep']]
+        self.logger.info("Scratch space in %s: %d exposures reserve %.1f GB, %d kept exposures use %.1f GB%s" % (
+            self.scratch_dir,
+            len(active), sum([e['bytes'] for (d, e) in active]) / 2**30,
+            len(kept), sum([e['bytes'] for (d, e) in kept]) / 2**30,
+            ", budget %.1f GB" % (self.budget / 2**30) if self.budget is not None else ""))
+        for (dir_name, entry) in sorted(active, key=lambda x: x[1]['time']):
+            self.logger.info("  %s (%s, pid %d): %.2f GB for %.0f seconds" % (
+                entry['obsid'], dir_name, entry['pid'], entry['bytes'] / 2**30,
+                time.time() - entry['time']))
+
+
+managers = {}
+managers_lock = threading.Lock()
+
+
+def open_manager(scratch_dir, budget=None):
+    # all exposures transferred by this process share the same manager
+    with managers_lock:
+        if (scratch_dir not in managers):
+            managers[scratch_dir] = ScratchManager(scratch_dir, budget)
+        return managers[scratch_dir]
@@ -0,0 +1,142 @@
+import os
+import time
+import atexit
+import tempfile
+import threading
+import subprocess
+import logging
+
+
+class SSHControlMaster(object):
+    """One multiplexed ssh connection (ControlMaster) to the archive server.
+    Other ssh, rsync and scp calls run through it by pointing ControlPath at
+    its socket, skipping the key exchange and authentication."""
+
+    def __init__(self, server, control_path, sshkey=None, timeout=30, persist=600, logger=None):
+        self.server = server
+        self.control_path = control_path
+        self.sshkey = sshkey
+        self.timeout = timeout
+        self.persist = persist
+        self.logger = logger if logger is not None else logging.getLogger("SSHPool")
+        self.setup_time = None
+        self.last_check = 0
+
+    def ssh(self, options):
+        cmd = ["ssh", "-o", "ControlPath=%s" % (self.control_path)]
+        if (self.sshkey is not None):
+            cmd += ["-i", self.sshkey]
+        return cmd + options + [self.server]
+
+    def run(self, cmd):
+        # the master keeps running in the background, so it must not inherit
+        # any pipe we would wait on
+        try:
+            return subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL, timeout=self.timeout).returncode
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self.logger.warning("%s failed: %s" % (" ".join(cmd), str(e)))
+            return -1
+
+    def connect(self):
+        if (os.path.exists(self.control_path)):
+            # left behind by a master that died
+            os.remove(self.control_path)
+        start_time = time.time()
+        returncode = self.run(self.ssh(["-M", "-N", "-f",
+                                        "-o", "ControlMaster=yes",
+                                        # in case we never get to close it
+                                        "-o", "ControlPersist=%d" % (self.persist),
+                                        "-o", "ServerAliveInterval=30"]))
+        if (returncode != 0):
+            self.logger.error("Unable to open ssh connection to %s (%d)" % (self.server, returncode))
+            return False
+        self.setup_time = time.time() - start_time
+        self.last_check = time.time()
+        self.logger.info("Opened ssh connection to %s in %.2f seconds (%s)" % (
+            self.server, self.setup_time, self.control_path))
+        return True
+
+    def check(self):
+        alive = (os.path.exists(self.control_path) and
+                 self.run(self.ssh(["-O", "check"])) == 0)
+        self.last_check = time.time()
+        return alive
+
+    def close(self):
+        if (os.path.exists(self.control_path)):
+            self.run(self.ssh(["-O", "exit"]))
+
+
+class SSHPool(object):
+    """A small pool of ssh control connections to the archive server, shared
+    by all transfer workers. Connections are opened on first use, checked
+    every check_interval seconds and re-opened if they died."""
+
+    def __init__(self, server, n_connections=1, sshkey=None, check_interval=60):
+        self.server = server
+        self.check_interval = check_interval
+        self.logger = logging.getLogger("SSHPool")
+        self.lock = threading.Lock()
+
+        self.masters = []
+        for i in range(max(1, n_connections)):
+            # sockets need a short path, so they go into /tmp rather than
+            # the scratch directory
+            control_path = os.path.join(tempfile.gettempdir(), "odi_dts_%d_%d.ssh" % (os.getpid(), i))
+            self.masters.append(SSHControlMaster(server, control_path, sshkey=sshkey, logger=self.logger))
+        self.next_master = 0
+
+        self.n_reused = 0
+        self.time_saved = 0.
+
+    def ssh_options(self, server):
+        # ssh options to run a command through one of the pooled connections,
+        # or an empty list if no connection is available
+        if (server != self.server):
+            return []
+
+        with self.lock:
+            master = self.masters[self.next_master]
+            self.next_master = (self.next_master + 1) % len(self.masters)
+
+            if (master.setup_time is None):
+                connected = master.connect()
+            elif (time.time() - master.last_check > self.check_interval and not master.check()):
+                self.logger.warning("ssh connection %s died, reconnecting" % (master.control_path))
+                connected = master.connect()
+            else:
+                connected = True
+                self.n_reused += 1
+                self.time_saved += master.setup_time
+                if (self.n_reused % 25 == 0):
+                    self.report()
+
+            if (not connected):
+                # try again next time, this one has to make its own connection
+                master.setup_time = None
+                return []
+
+        return ["-o", "ControlPath=%s" % (master.control_path), "-o", "ControlMaster=no"]
+
+    def report(self):
+        self.logger.info("Re-used pooled ssh connections %d times, saving about %.1f seconds of connection setup" % (
+            self.n_reused, self.time_saved))
+
+    def close(self):
+        self.report()
+        for master in self.masters:
+            master.close()
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def open_pool(server, n_connections, sshkey):
+    # all exposures transferred by this process share the same pool
+    with pools_lock:
+        if (server not in pools):
+            pools[server] = SSHPool(server, n_connections=n_connections, sshkey=sshkey)
+            atexit.register(pools[server].close)
+        return pools[server]